@@ -0,0 +1,210 @@
+"""
+Event loop engine for the reliable sender and receiver. Sending, ACK handling and retransmit timers all run as
+callbacks on one asyncio loop instead of a loop blocking on socket timeouts. Needs Python 3; importing this module
+on Python 2 raises ImportError. Written with callbacks rather than coroutines so the module still compiles there.
+"""
+import asyncio
+import time
+
+from channelsimulator import slice_frames
+from receiver import ReliableReceiver
+from sender import ReliableSender, stream_length
+
+
+class ChannelProtocol(asyncio.DatagramProtocol):
+    """
+    Carries one endpoint's frames over the socket its ChannelSimulator bound, corrupting outbound frames exactly as
+    ChannelSimulator.u_send_batch does
+    """
+
+    def __init__(self, simulator, on_frames):
+        """
+        Create a ChannelProtocol
+        :param simulator: ChannelSimulator whose socket, corruption and peer address are used
+        :param on_frames: called with a list of received frames
+        """
+        self.simulator = simulator
+        self.on_frames = on_frames
+        self.address = (simulator.ip, simulator.sndr_port)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_frames([bytearray(data)])
+
+    def error_received(self, exc):
+        # ICMP port unreachable while the peer is not listening yet; the retransmit timers cover it
+        pass
+
+    def send_batch(self, frames):
+        """
+        Send several byte arrays through the unreliable channel
+        :param frames: iterable of byte arrays to send
+        :return:
+        """
+        corrupt = self.simulator.corrupt
+        for data_bytes in frames:
+            for frame in slice_frames(data_bytes):
+                corrupted = corrupt(frame)
+                # the transport copies anything it has to queue, so pooled buffers may be reused right away
+                if corrupted is not None:
+                    self.transport.sendto(corrupted, self.address)
+
+    def connect(self, loop):
+        """
+        Hand the simulator's bound receive socket, set up with rcvr_setup, over to the loop. Datagrams already
+        queued on the socket may reach on_frames before this returns, so the endpoint must be ready for them first.
+        :param loop: asyncio event loop
+        :return:
+        """
+        loop.run_until_complete(loop.create_datagram_endpoint(lambda: self, sock=self.simulator.rcvr_socket))
+
+    def close(self, loop):
+        """
+        Close the transport and let the loop release the socket, which it only does on its next pass
+        :param loop: asyncio event loop passed to connect
+        :return:
+        """
+        self.transport.close()
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+class AsyncSender(ReliableSender):
+    """
+    ReliableSender driven by an event loop: every ACK and every timer expiry wakes the same pump, which
+    retransmits what expired, fills the window and rearms one timer for the next deadline or pacing slot
+    """
+
+    def send_stream(self, source, length=None):
+        self.logger.info("Sending on port: %s and waiting for ACK on port: %s", self.outbound_port, self.inbound_port)
+
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.channel = ChannelProtocol(self.simulator, self.on_frames)
+            self.finished = self.loop.create_future()
+            self.timer = None
+            self.start(source, length if length is not None else stream_length(source))
+            self.channel.connect(self.loop)
+            self.pump()
+            self.loop.run_until_complete(self.finished)
+            self.channel.close(self.loop)
+        finally:
+            self.loop.close()
+        self.check_aborted()
+        self.finish()
+
+    def transmit(self, frames):
+        self.channel.send_batch(frames)
+
+    def on_frames(self, frames):
+        """
+        (INTERNAL) Take ACKs as they arrive, then use whatever room they opened
+        :param frames: ACK frames
+        :return:
+        """
+        self.handle_acks(frames, time.time())
+        self.pump()
+
+    def pump(self):
+        """
+        (INTERNAL) Retransmit expired frames, send new ones, and schedule the next wake up
+        :return:
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.finished.done():
+            return
+        self.expire(time.time())
+        pace_delay = self.fill()
+        if self.done:
+            self.finished.set_result(None)
+            return
+        wait = self.wait_time(pace_delay) if self.outstanding or self.control is not None else pace_delay
+        self.timer = self.loop.call_later(wait, self.pump)
+
+
+class AsyncReceiver(ReliableReceiver):
+    """
+    ReliableReceiver driven by an event loop. Each datagram is handled as it arrives, and an ACK held back for more
+    frames is sent by a timer once it is due. The receiver stops once the transfer closes, or after the socket's
+    timeout passes without any datagram, as the blocking receiver does.
+    """
+
+    def receive(self):
+        self.logger.info("Receiving on port: %s and replying with ACK on port: %s", self.inbound_port, self.outbound_port)
+
+        self.idle_timeout = self.simulator.rcvr_socket.gettimeout()
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.channel = ChannelProtocol(self.simulator, self.on_frames)
+            self.finished = self.loop.create_future()
+            self.ack_timer = None
+            self.last_frame = time.time()
+            self.channel.connect(self.loop)
+            self.loop.call_later(self.idle_timeout, self.check_idle)
+            self.loop.run_until_complete(self.finished)
+            self.channel.close(self.loop)
+        finally:
+            self.loop.close()
+            self.writer.close()
+        self.logger.info("Wrote %s bytes, rebuilt %s frames from parity", self.writer.written, self.metrics["recovered"])
+
+    def stop(self):
+        """
+        Stop receiving. Safe to call from another thread, and after the receiver has stopped on its own.
+        :return:
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.finish)
+        except RuntimeError:
+            pass  # the loop has already closed
+
+    def finish(self):
+        """
+        (INTERNAL) End the loop, on the loop's thread
+        :return:
+        """
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+    def on_frames(self, frames):
+        """
+        (INTERNAL) Take in frames as they arrive and answer them
+        :param frames: frames received from the channel
+        :return:
+        """
+        self.last_frame = time.time()
+        self.channel.send_batch(self.handle_frames(frames))
+        if self.closed:
+            self.finish()
+        elif self.ack_deadline is not None and self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(self.ack_deadline - self.last_frame, self.send_delayed_ack)
+
+    def send_delayed_ack(self):
+        """
+        (INTERNAL) Send the ACK held back since ack_deadline was set, or wait on if an ACK went out meanwhile and a
+        later deadline replaced it
+        :return:
+        """
+        self.ack_timer = None
+        if self.ack_deadline is None:
+            return
+        wait = self.ack_deadline - time.time()
+        if wait > 0:
+            self.ack_timer = self.loop.call_later(wait, self.send_delayed_ack)
+        else:
+            self.channel.send_batch(self.delayed_ack())
+
+    def check_idle(self):
+        """
+        (INTERNAL) Stop once idle_timeout has passed since the last frame, otherwise look again when it would have
+        :return:
+        """
+        idle = time.time() - self.last_frame
+        if idle >= self.idle_timeout:
+            self.finish()
+        else:
+            self.loop.call_later(self.idle_timeout - idle, self.check_idle)
@@ -0,0 +1,280 @@
+import argparse
+import base64
+import csv
+import hashlib
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from random import Random, getrandbits
+
+import checksum
+import header
+from channelsimulator import ChannelSimulator
+from loopback import LoopbackChannel, LoopbackNetwork
+from receiver import ReliableReceiver
+from sender import ReliableSender
+
+# region Constants
+
+E2E_SIZES_MB = (10, 25, 100)  # the input sizes instructions.txt grades on
+# (drop, random error, swap) probabilities: a clean channel, the default channel, and each error made ten times worse
+E2E_SCENARIOS = (
+    (0, 0, 0),
+    (0.005, 0.005, 0.005),
+    (0.05, 0.005, 0.005),
+    (0.005, 0.05, 0.005),
+    (0.005, 0.005, 0.05),
+)
+E2E_COLUMNS = ("size_mb", "channel", "compress", "drop_error_prob", "random_error_prob", "swap_error_prob", "seed",
+               "seconds", "goodput_mb_per_s", "frames", "retransmissions", "retransmit_ratio", "intact")
+# endregion Constants
+
+# region Helper Functions
+
+
+def random_payload(n):
+    """
+    Build n random bytes in one call
+    :param n: number of bytes
+    :return: bytearray of length n
+    """
+    return bytearray(getrandbits(8) for _ in range(n)) if n < 64 else bytearray(
+        bytearray.fromhex("{:0{}x}".format(getrandbits(8 * n), 2 * n)))
+
+
+def seconds_per_call(func, repeat=5, number=10):
+    """
+    Time a function call, keeping the fastest of several runs
+    :param func: callable taking no arguments
+    :param repeat: number of timing runs
+    :param number: number of calls per run
+    :return: seconds per call
+    """
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def generate_input(path, size, seed=0):
+    """
+    Write size bytes of base64 text without newlines, like
+    base64 /dev/urandom | head -c size | tr -d '\\n', but drawn from a seeded generator so runs are comparable
+    :param path: file to write
+    :param size: number of bytes
+    :param seed: seed for the random bytes
+    :return:
+    """
+    rng = Random(seed)
+    block = 3 * 2 ** 18  # raw bytes per write, a multiple of 3 so no padding shows up mid-file
+    with open(path, "wb") as f:
+        left = size
+        while left > 0:
+            raw = bytes(bytearray.fromhex("{:0{}x}".format(rng.getrandbits(8 * block), 2 * block)))
+            text = base64.b64encode(raw)[:left]
+            f.write(text)
+            left -= len(text)
+
+
+def cached_input(size_mb, directory, seed=0):
+    """
+    Path of a generated input file, generating it on first use
+    :param size_mb: size in units of 10 ** 6 bytes
+    :param directory: directory the inputs are kept in between runs
+    :param seed: seed for the random bytes
+    :return: path
+    """
+    path = os.path.join(directory, "file_{}MB_{}.txt".format(size_mb, seed))
+    if not os.path.exists(path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        generate_input(path, size_mb * 10 ** 6, seed)
+    return path
+
+
+class DigestWriter(object):
+    """
+    Binary output stream that keeps only a running hash and length of what was written
+    """
+
+    def __init__(self):
+        self.digest = hashlib.sha1()
+        self.length = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.length += len(data)
+
+    def flush(self):
+        pass
+
+
+def file_digest(path):
+    """
+    Hash a file the way DigestWriter hashes a stream
+    :param path: file to hash
+    :return: (sha1 hex digest, length)
+    """
+    writer = DigestWriter()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            writer.write(chunk)
+    return writer.digest.hexdigest(), writer.length
+# endregion Helper Functions
+
+
+def bench_checksum(frame_size=1024, megabytes=1):
+    """
+    Checksum megabytes of frames with every algorithm and with the original per-byte mod 255 loop
+    :param frame_size: bytes per frame
+    :param megabytes: amount of data checksummed per call
+    :return: list of (algorithm, milliseconds per MB, speedup over the legacy loop)
+    """
+    frames = [random_payload(frame_size) for _ in range(megabytes * 2 ** 20 // frame_size)]
+
+    def per_mb(func):
+        return 1000 * seconds_per_call(lambda: [func(frame) for frame in frames], number=1) / megabytes
+
+    legacy = per_mb(checksum.legacy_checksum)
+    results = [("legacy", legacy, 1.0)]
+    for name in sorted(checksum.ALGORITHMS):
+        elapsed = per_mb(checksum.ALGORITHMS[name])
+        results.append((name, elapsed, legacy / elapsed))
+    return results
+
+
+def bench_header(payload_size=1009):
+    """
+    Encode and decode one MB of payload split into frames, checksum included. Multiply by 100 for the cost of
+    framing a 100 MB transfer.
+    :param payload_size: payload bytes per frame
+    :return: list of (operation, milliseconds per MB, speedup over encode)
+    """
+    payload = random_payload(payload_size)
+    frame = header.encode(12345, payload)
+    buffer = bytearray(len(frame))
+    frames_per_mb = 2.0 ** 20 / payload_size
+
+    def per_mb(func):
+        return 1000 * seconds_per_call(func, number=int(frames_per_mb)) * frames_per_mb
+
+    encode = per_mb(lambda: header.encode(12345, payload))
+    results = [("encode", encode, 1.0)]
+    for name, func in (("pack_into", lambda: header.pack_into(buffer, 12345, payload)),
+                       ("decode", lambda: header.decode(frame))):
+        elapsed = per_mb(func)
+        results.append((name, elapsed, encode / elapsed))
+    return results
+
+
+def run_transfer(path, channel="loopback", seed=0, drop_error_prob=0.005, random_error_prob=0.005,
+                 swap_error_prob=0.005, compress=False):
+    """
+    Send a file from a ReliableSender to a ReliableReceiver running in a thread of this process
+    :param path: input file
+    :param channel: "loopback" for LoopbackChannel, or "udp" for ChannelSimulator over real sockets
+    :param seed: seed for the data channel; the ACK channel uses seed + 1
+    :param drop_error_prob: drop frame error probability in both directions
+    :param random_error_prob: random bit error probability in both directions
+    :param swap_error_prob: swap frame error probability in both directions
+    :param compress: compress the stream before framing it
+    :return: dict with a value for every one of E2E_COLUMNS but size_mb
+    """
+    probs = dict(drop_error_prob=drop_error_prob, random_error_prob=random_error_prob, swap_error_prob=swap_error_prob)
+    if channel == "loopback":
+        network = LoopbackNetwork()
+        data_channel = LoopbackChannel(50006, 50005, seed=seed, network=network, **probs)
+        ack_channel = LoopbackChannel(50005, 50006, seed=seed + 1, network=network, **probs)
+    elif channel == "udp":
+        data_channel = ChannelSimulator(50006, 50005, seed=seed, **probs)
+        ack_channel = ChannelSimulator(50005, 50006, seed=seed + 1, **probs)
+    else:
+        raise ValueError("Unknown channel: {}".format(channel))
+
+    output = DigestWriter()
+    receiver = ReliableReceiver(output=output, simulator=ack_channel)
+    thread = threading.Thread(target=receiver.receive)
+    thread.start()
+    try:
+        sender = ReliableSender(compress=compress, simulator=data_channel)
+        start = time.time()
+        with open(path, "rb") as source:
+            sender.send_stream(source)
+        seconds = time.time() - start
+    finally:
+        thread.join()
+        for simulator in (data_channel, ack_channel):
+            if channel == "loopback":
+                simulator.close()
+            else:
+                simulator.sndr_socket.close()
+                simulator.rcvr_socket.close()
+
+    expected = file_digest(path)
+    result = dict(channel=channel, compress=compress, seed=seed, seconds=seconds, frames=sender.next_index,
+                  retransmissions=sender.metrics["retransmits"],
+                  retransmit_ratio=float(sender.metrics["retransmits"]) / sender.next_index if sender.next_index else 0.0,
+                  goodput_mb_per_s=expected[1] / 1e6 / seconds if seconds else 0.0,
+                  intact=(output.digest.hexdigest(), output.length) == expected)
+    result.update(probs)
+    return result
+
+
+def bench_e2e(argv):
+    """
+    Sweep file sizes and channel error rates, writing one CSV row per transfer
+    :param argv: command line arguments after "e2e"
+    :return: True if every transfer arrived intact
+    """
+    parser = argparse.ArgumentParser(prog="benchmark.py e2e", description=bench_e2e.__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=E2E_SIZES_MB, help="input sizes, in MB")
+    parser.add_argument("--drop", type=float, nargs="+", help="drop error probabilities to sweep")
+    parser.add_argument("--error", type=float, nargs="+", help="random error probabilities to sweep")
+    parser.add_argument("--swap", type=float, nargs="+", help="swap error probabilities to sweep")
+    parser.add_argument("--channel", choices=("loopback", "udp"), default="loopback")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compress", action="store_true", help="compress the stream before framing it")
+    parser.add_argument("--inputs", default=os.path.join(tempfile.gettempdir(), "ece303_inputs"),
+                        help="directory generated inputs are kept in")
+    parser.add_argument("--output", help="CSV file to write, stdout by default")
+    args = parser.parse_args(argv)
+
+    if args.drop or args.error or args.swap:
+        scenarios = list(itertools.product(args.drop or [0.005], args.error or [0.005], args.swap or [0.005]))
+    else:
+        scenarios = E2E_SCENARIOS
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(output, E2E_COLUMNS)
+        writer.writeheader()
+        intact = True
+        for size_mb in args.sizes:
+            path = cached_input(size_mb, args.inputs, args.seed)
+            for drop, error, swap in scenarios:
+                row = run_transfer(path, args.channel, args.seed, drop, error, swap, args.compress)
+                row["size_mb"] = size_mb
+                writer.writerow(row)
+                output.flush()
+                intact = intact and row["intact"]
+        return intact
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+BENCHMARKS = {
+    "checksum": bench_checksum,
+    "header": bench_header,
+}
+
+
+if __name__ == "__main__":
+    # usage: python benchmark.py [name ...]
+    #        python benchmark.py e2e [--sizes MB ...] [--drop P ...] [--error P ...] [--swap P ...] [--output CSV]
+    if sys.argv[1:2] == ["e2e"]:
+        sys.exit(0 if bench_e2e(sys.argv[2:]) else 1)
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print(name)
+        for row in BENCHMARKS[name]():
+            print("  {:<12} {:>10.3f} ms/MB {:>8.1f}x".format(*row))
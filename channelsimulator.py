@@ -1,39 +1,59 @@
 # Written by S. Mevawala, modified by D. Gitzel
 
+import errno
 import logging
 import socket
 from collections import deque
-from random import randint, choice, uniform
-from copy import deepcopy
+from math import log
+from random import Random
 
 import utils
+from intcodec import bytes_to_int, int_to_bytes
+from metrics import Metrics
 
 # region Helper Functions
 
 
-def random_bytes(n):
-    return bytearray([randint(0, 255) for i in xrange(n)])
+def random_bytes(n, rng):
+    return int_to_bytes(rng.getrandbits(8 * n), n) if n else bytearray()
 
 
-def slice_frames(data_bytes):
+def xor_bytes(data_bytes, mask):
     """
-    Slice input into BUFFER_SIZE frames
+    XOR two equal length byte arrays as whole integers instead of byte by byte
     :param data_bytes: input bytes
-    :return: list of frames of size BUFFER_SIZE
+    :param mask: bytes to XOR in
+    :return: new bytearray
+    """
+    return int_to_bytes(bytes_to_int(data_bytes) ^ bytes_to_int(mask), len(data_bytes))
+
+
+def geometric_skip(prob, rng):
+    """
+    Sample how many frames pass before the next error event, for an event that hits each frame
+    independently with probability prob. Drawing this once per event gives the same statistics as one
+    uniform draw per frame.
+    :param prob: per-frame event probability
+    :param rng: random.Random to draw from
+    :return: number of frames to skip, or None if the event can never happen
     """
-    frames = list()
-    num_bytes = len(data_bytes)
-    extra = 1 if num_bytes % ChannelSimulator.BUFFER_SIZE else 0
+    if prob <= 0:
+        return None
+    if prob >= 1:
+        return 0
+    return int(log(1.0 - rng.random()) / log(1.0 - prob))
+
 
-    for i in xrange(num_bytes / ChannelSimulator.BUFFER_SIZE + extra):
+def slice_frames(data_bytes):
+    """
+    Lazily slice input into BUFFER_SIZE frames without copying it
+    :param data_bytes: input bytes
+    :return: generator of memoryview frames of size BUFFER_SIZE over data_bytes; the last one may be shorter
+    """
+    view = memoryview(data_bytes)
+    for start in range(0, len(view), ChannelSimulator.BUFFER_SIZE):
         # split data into 1024 byte frames
-        frames.append(
-            data_bytes[
-                i * ChannelSimulator.BUFFER_SIZE:
-                i * ChannelSimulator.BUFFER_SIZE + ChannelSimulator.BUFFER_SIZE
-            ]
-        )
-    return frames
+        yield view[start:start + ChannelSimulator.BUFFER_SIZE]
 # endregion Helper Functions
 
 
@@ -44,21 +64,38 @@ class ChannelSimulator(object):
     PROTOCOL_VERSION = 5
     BUFFER_SIZE = 1024
     CORRUPTERS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 255)
+    POOL_FRAMES = 16  # frames worth of corruption masks and random filler generated per refill
+    # Maps a random byte onto CORRUPTERS. Bytes 250-255 are deleted so every corrupter stays equally likely.
+    CORRUPTER_TABLE = bytes(bytearray(CORRUPTERS * (256 // len(CORRUPTERS) + 1))[:256])
+    CORRUPTER_REJECTS = bytes(bytearray(range(256 // len(CORRUPTERS) * len(CORRUPTERS), 256)))
     # endregion Constants
 
-    def __init__(self, inbound_port, outbound_port, debug_level=logging.INFO, ip_addr="127.0.0.1"):
+    def __init__(self, inbound_port, outbound_port, debug_level=logging.INFO, ip_addr="127.0.0.1", seed=None,
+                 drop_error_prob=0.005, random_error_prob=0.005, swap_error_prob=0.005):
         """
         Create a ChannelSimulator
         :param inbound_port: port number for inbound connections
         :param outbound_port: port number of outbound connections
         :param debug_level: debug level for logging (e.g. logging.DEBUG)
         :param ip_addr: destination IP
+        :param seed: seed for every random choice the channel makes, so a run's errors can be repeated exactly
+        :param drop_error_prob: drop frame error probability used by corrupt by default
+        :param random_error_prob: random bit error probability used by corrupt by default
+        :param swap_error_prob: swap frame error probability used by corrupt by default
         """
 
+        self.rng = Random(seed)
+        self.drop_error_prob = drop_error_prob
+        self.random_error_prob = random_error_prob
+        self.swap_error_prob = swap_error_prob
+        self.metrics = Metrics()  # frames put through corrupt and the errors injected into them
         self.ip = ip_addr
         self.sndr_socket = None
         self.rcvr_socket = None
-        self.swap_queue = deque([random_bytes(ChannelSimulator.BUFFER_SIZE), random_bytes(ChannelSimulator.BUFFER_SIZE)])
+        self.mask_pool = bytearray()
+        self.filler_pool = list()
+        self.skips = dict()  # error kind -> (probability, frames left before the next event)
+        self.swap_queue = deque([self.filler_frame(), self.filler_frame()])
         self.debug = debug_level == logging.DEBUG
         if self.debug:
             self.logger = utils.Logger(self.__class__.__name__, debug_level)
@@ -68,6 +105,51 @@ class ChannelSimulator(object):
         self.sndr_port = outbound_port
         self.rcvr_port = inbound_port
 
+    def filler_frame(self):
+        """
+        (INTERNAL) Take a random frame from the filler pool, refilling the pool in one call when it runs out
+        :return: random bytearray of size BUFFER_SIZE
+        """
+        if not self.filler_pool:
+            block = random_bytes(ChannelSimulator.BUFFER_SIZE * ChannelSimulator.POOL_FRAMES, self.rng)
+            self.filler_pool = [block[i:i + ChannelSimulator.BUFFER_SIZE]
+                                for i in range(0, len(block), ChannelSimulator.BUFFER_SIZE)]
+        return self.filler_pool.pop()
+
+    def corruption_mask(self, n):
+        """
+        (INTERNAL) Take n bytes drawn uniformly from CORRUPTERS, refilling the mask pool in bulk when it runs out
+        :param n: mask length
+        :return: bytearray of length n
+        """
+        while len(self.mask_pool) < n:
+            block = random_bytes(max(n, ChannelSimulator.BUFFER_SIZE * ChannelSimulator.POOL_FRAMES), self.rng)
+            self.mask_pool += block.translate(ChannelSimulator.CORRUPTER_TABLE, ChannelSimulator.CORRUPTER_REJECTS)
+        mask = self.mask_pool[:n]
+        del self.mask_pool[:n]
+        return mask
+
+    def error_event(self, kind, prob):
+        """
+        (INTERNAL) Advance the skip-ahead counter for one kind of error by one frame
+        :param kind: name of the error kind
+        :param prob: per-frame probability of this kind of error
+        :return: True if the error hits the current frame
+        """
+        skip_prob, skip = self.skips.get(kind, (None, None))
+        if skip_prob != prob:
+            skip = geometric_skip(prob, self.rng)
+        if skip is None:
+            hit = False
+        elif skip:
+            skip -= 1
+            hit = False
+        else:
+            skip = geometric_skip(prob, self.rng)
+            hit = True
+        self.skips[kind] = (prob, skip)
+        return hit
+
     def sndr_setup(self, timeout):
         """
         Setup the sender socket
@@ -101,10 +183,38 @@ class ChannelSimulator(object):
         :return: bit string of data from the socket
         """
         while True:
-            data, address = self.rcvr_socket.recvfrom(ChannelSimulator.BUFFER_SIZE)  # buffer size is 1024 bytes
-            return bytearray(data)
+            try:
+                data, address = self.rcvr_socket.recvfrom(ChannelSimulator.BUFFER_SIZE)  # buffer size is 1024 bytes
+                return bytearray(data)
+            except socket.error as e:
+                # Python 2 does not retry a wait cut short by a signal, such as a metrics dump request
+                if e.errno != errno.EINTR:
+                    raise
 
-    def corrupt(self, data_bytes, drop_error_prob=0.005, random_error_prob=0.005, swap_error_prob=0.005):
+    def get_batch_from_socket(self, max_frames):
+        """
+        (INTERNAL) Drain whatever is already queued on the socket without blocking
+        :param max_frames: maximum number of datagrams to read
+        :return: list of bit strings of data from the socket, possibly empty
+        """
+        frames = list()
+        recvfrom = self.rcvr_socket.recvfrom
+        timeout = self.rcvr_socket.gettimeout()
+        self.rcvr_socket.setblocking(False)
+        try:
+            while len(frames) < max_frames:
+                try:
+                    data, address = recvfrom(ChannelSimulator.BUFFER_SIZE)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                frames.append(bytearray(data))
+        finally:
+            self.rcvr_socket.settimeout(timeout)
+        return frames
+
+    def corrupt(self, data_bytes, drop_error_prob=None, random_error_prob=None, swap_error_prob=None):
         """
         Corrupt data in the channel with random errors, swaps, and drops.
         In this implementation, random errors will manifest as single byte errors most of the time. Occasionally, an
@@ -113,50 +223,79 @@ class ChannelSimulator(object):
         The queue is initialized with two random frames.
         Drop errors drop the current frame and all the frames "delayed" in the swap queue.
 
-        :param swap_error_prob: swap frame error probability
-        :param random_error_prob: random bit error probability
-        :param drop_error_prob: drop frame error probability
+        :param swap_error_prob: swap frame error probability, the channel's swap_error_prob if None
+        :param random_error_prob: random bit error probability, the channel's random_error_prob if None
+        :param drop_error_prob: drop frame error probability, the channel's drop_error_prob if None
         :param data_bytes: byte array (frame) to corrupt
         :return: corrupted byte array
         """
         if self.debug:
-            logging.debug("Sending bytes through corrupting channel")
-        p_error = uniform(0, 1)
-        p_swap = uniform(0, 1)
-        p_drop = uniform(0, 1)
-        corrupted = deepcopy(data_bytes)
-        if p_drop < drop_error_prob:
+            self.logger.debug("Sending bytes through corrupting channel")
+        if drop_error_prob is None:
+            drop_error_prob = self.drop_error_prob
+        if random_error_prob is None:
+            random_error_prob = self.random_error_prob
+        if swap_error_prob is None:
+            swap_error_prob = self.swap_error_prob
+        is_drop, mask, swap_end = self.draw_events(len(data_bytes), drop_error_prob, random_error_prob,
+                                                   swap_error_prob)
+        self.metrics.count("frames")
+        corrupted = data_bytes
+        if is_drop:
+            self.metrics.count("drops")
             if self.debug:
-                logging.debug("Dropping delayed and swapped frames: {}".format(self.swap_queue))
+                self.logger.debug("Dropping delayed and swapped frames: %s", self.swap_queue)
             # drop all the delayed frames in the swap queue
             self.swap_queue.clear()
-            self.swap_queue += [random_bytes(ChannelSimulator.BUFFER_SIZE), random_bytes(ChannelSimulator.BUFFER_SIZE)]
+            self.swap_queue += [self.filler_frame(), self.filler_frame()]
             if self.debug:
-                logging.debug("Dropping current frame: {}".format(data_bytes))
+                self.logger.debug("Dropping current frame: %s", data_bytes)
             return None
-        if p_error < random_error_prob:
+        if mask is not None:
+            self.metrics.count("corruptions")
             # insert random errors into the frame
             if self.debug:
-                logging.debug("Frame before random errors: {}".format(data_bytes))
-            for n in xrange(len(data_bytes)):
-                # XOR a random corrupter byte to change a single bit, none of the bits, or all the bits
-                corrupted[n] ^= choice(ChannelSimulator.CORRUPTERS)
+                self.logger.debug("Frame before random errors: %s", data_bytes)
+            # XOR a random corrupter byte into every byte to change a single bit, none of the bits, or all the bits
+            corrupted = xor_bytes(data_bytes, mask)
             if self.debug:
-                logging.debug("Frame after random errors: {}".format(corrupted))
-        if p_swap < swap_error_prob:
+                self.logger.debug("Frame after random errors: %s", corrupted)
+        if swap_end is not None:
+            self.metrics.count("swaps")
             if self.debug:
-                logging.debug("Frame before swap: {}".format(data_bytes))
+                self.logger.debug("Frame before swap: %s", data_bytes)
             # swap packets with an earlier packet by popping it off the swap queue
-            if p_swap < swap_error_prob / 2:
+            if swap_end:
                 corrupted = self.swap_queue.pop()
             else:
                 corrupted = self.swap_queue.popleft()
-            # store the current packet in the queue
-            self.swap_queue.append(data_bytes)
+            # store a copy of the current packet in the queue, since the caller may reuse its buffer
+            self.swap_queue.append(bytearray(data_bytes))
             if self.debug:
-                logging.debug("Frame after swap: {}".format(corrupted))
+                self.logger.debug("Frame after swap: %s", corrupted)
         return corrupted
 
+    def draw_events(self, n, drop_error_prob, random_error_prob, swap_error_prob):
+        """
+        (INTERNAL) Draw what the channel does to the next frame
+        :param n: length of the frame
+        :param drop_error_prob: drop frame error probability
+        :param random_error_prob: random bit error probability
+        :param swap_error_prob: swap frame error probability
+        :return: (is_drop, mask, swap_end): whether the frame is dropped, the bytearray XORed into it or None, and
+            None or the end of the swap queue the delivered frame is taken from, 0 for the left and 1 for the right
+        """
+        # every kind of error is advanced on every frame, as the three uniform draws used to be
+        is_error = self.error_event("error", random_error_prob)
+        is_swap = self.error_event("swap", swap_error_prob)
+        is_drop = self.error_event("drop", drop_error_prob)
+        if is_drop:
+            return True, None, None
+        mask = self.corruption_mask(n) if is_error else None
+        # either end of the swap queue is equally likely
+        swap_end = self.rng.getrandbits(1) if is_swap else None
+        return False, mask, swap_end
+
     def u_send(self, data_bytes):
         """
         Send data through unreliable channel
@@ -164,16 +303,51 @@ class ChannelSimulator(object):
         :return:
         """
 
-        # split data into 1024 byte frames
+        # stream 1024 byte frames straight out of the caller's buffer
         for frame in slice_frames(data_bytes):
             corrupted = self.corrupt(frame)
             # put corrupted frame into socket if it wasn't dropped
-            if corrupted:
+            if corrupted is not None:
                 self.put_to_socket(corrupted)
 
+    def u_send_batch(self, frames):
+        """
+        Send several byte arrays through unreliable channel in one call
+        :param frames: iterable of byte arrays to send
+        :return:
+        """
+        corrupt = self.corrupt
+        put_to_socket = self.put_to_socket
+        for data_bytes in frames:
+            for frame in slice_frames(data_bytes):
+                corrupted = corrupt(frame)
+                # put corrupted frame into socket if it wasn't dropped
+                if corrupted is not None:
+                    put_to_socket(corrupted)
+
     def u_receive(self):
         """
         Receive data through unreliable channel
         :return: byte array of data
         """
         return self.get_from_socket()
+
+    def u_receive_batch(self, max_frames=64, timeout=None):
+        """
+        Receive every datagram already waiting in the unreliable channel, blocking only for the first one
+        :param max_frames: maximum number of byte arrays to return
+        :param timeout: seconds to wait for the first datagram this time only, or None for the socket's own timeout
+        :return: list of at least one byte array of data; raises socket.timeout if nothing arrives in time
+        """
+        if timeout is not None:
+            previous = self.rcvr_socket.gettimeout()
+            self.rcvr_socket.settimeout(timeout)
+            try:
+                frames = [self.get_from_socket()]
+            finally:
+                self.rcvr_socket.settimeout(previous)
+        else:
+            frames = [self.get_from_socket()]
+        if max_frames > 1:
+            frames += self.get_batch_from_socket(max_frames - 1)
+        return frames
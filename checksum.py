@@ -0,0 +1,108 @@
+import zlib
+
+from intcodec import bytes_to_int
+
+_FLETCHER_MODULUS = 65535
+
+# region Helper Functions
+
+
+def _view(data, offset=0, end=None):
+    """
+    Wrap data without copying it so that zlib and struct can read it
+    :param data: bytearray, bytes or memoryview
+    :param offset: number of leading bytes to skip
+    :param end: index one past the last byte to read, None for the end of data
+    :return: read-only view of data[offset:end]
+    """
+    try:
+        if isinstance(data, memoryview):
+            # Python 2 buffer() does not understand memoryview, so fall back to one copy there
+            return data[offset:end].tobytes()
+        if end is None:
+            return buffer(data, offset)  # Python 2: zlib only takes str or read-only buffers
+        return buffer(data, offset, end - offset)
+    except NameError:
+        return memoryview(data)[offset:end]
+
+
+def crc32(data, offset=0, end=None):
+    """
+    CRC-32 (IEEE 802.3), computed in C by zlib
+    :param data: bytes to checksum
+    :param offset: number of leading bytes to skip
+    :param end: index one past the last byte covered, None for the end of data
+    :return: unsigned 32 bit checksum
+    """
+    return zlib.crc32(_view(data, offset, end)) & 0xffffffff
+
+
+def adler32(data, offset=0, end=None):
+    """
+    Adler-32, computed in C by zlib
+    :param data: bytes to checksum
+    :param offset: number of leading bytes to skip
+    :param end: index one past the last byte covered, None for the end of data
+    :return: unsigned 32 bit checksum
+    """
+    return zlib.adler32(_view(data, offset, end)) & 0xffffffff
+
+
+def fletcher32(data, offset=0, end=None):
+    """
+    Fletcher-32 over little-endian 16 bit words, with an odd trailing byte padded with zero.
+    Read the data as one integer N = sum(w_i * x ** i) with x = 2 ** 16. Since x = 1 + 65535, reducing N modulo
+    65535 ** 2 leaves sum(w_i) + 65535 * sum(i * w_i), and both Fletcher sums follow from that and the plain word
+    sum without a Python-level loop over the words.
+    :param data: bytes to checksum
+    :param offset: number of leading bytes to skip
+    :param end: index one past the last byte covered, None for the end of data
+    :return: unsigned 32 bit checksum
+    """
+    view = bytearray(_view(data, offset, end))
+    count = (len(view) + 1) // 2
+    word_sum = sum(view[0::2]) + 256 * sum(view[1::2])
+    weighted_sum = ((bytes_to_int(view, "little") % _FLETCHER_MODULUS ** 2) - word_sum) % _FLETCHER_MODULUS ** 2 \
+        // _FLETCHER_MODULUS
+    sum1 = word_sum % _FLETCHER_MODULUS
+    sum2 = (count * word_sum - weighted_sum) % _FLETCHER_MODULUS
+    return (sum2 << 16) | sum1
+
+
+def legacy_checksum(data, offset=0, end=None):
+    """
+    The original byte-at-a-time sum modulo 255, kept for comparison in benchmarks
+    :param data: bytes to checksum
+    :param offset: number of leading bytes to skip
+    :param end: index one past the last byte covered, None for the end of data
+    :return: checksum in the range 0-254
+    """
+    result = 0
+    for i in bytearray(_view(data, offset, end)):
+        result = result + i
+        result = result % 255
+    return result
+# endregion Helper Functions
+
+
+ALGORITHMS = {
+    "crc32": crc32,
+    "adler32": adler32,
+    "fletcher32": fletcher32,
+}
+DEFAULT_ALGORITHM = "crc32"
+
+
+def compute(data, algorithm=DEFAULT_ALGORITHM, offset=0, end=None):
+    """
+    Compute a 32 bit checksum with the selected algorithm
+    :param data: bytes to checksum
+    :param algorithm: one of ALGORITHMS
+    :param offset: number of leading bytes to skip, so a frame header can be stepped over without a copy
+    :param end: index one past the last byte covered, so a frame can be checksummed inside a larger buffer
+    :return: unsigned 32 bit checksum
+    """
+    try:
+        return ALGORITHMS[algorithm](data, offset, end)
+    except KeyError:
+        raise ValueError("Unknown checksum algorithm: {}".format(algorithm))
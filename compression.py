@@ -0,0 +1,80 @@
+"""
+Streaming zlib stage between the input and the framing. The sender compresses the stream chunk by chunk as the
+window pulls on it, and marks every frame of a compressed transfer with header.FLAG_COMPRESSED so the receiver knows
+to inflate what it writes out.
+"""
+import zlib
+
+import utils
+
+# region Constants
+
+LEVEL = 1  # on base64 input, higher levels shrink the stream by another 2% at several times the cost
+READ_SIZE = 64 * 1024  # bytes read from a file object per chunk handed to the compressor
+# endregion Constants
+
+# region Helper Functions
+
+
+def as_buffer(chunk):
+    """
+    (INTERNAL) Python 2's zlib only takes strings
+    :param chunk: bytes, bytearray or memoryview
+    :return: chunk, or a string copy of it on Python 2
+    """
+    if bytes is str and not isinstance(chunk, str):
+        return memoryview(chunk).tobytes()
+    return chunk
+
+
+def compress_stream(source, level=LEVEL):
+    """
+    Compress a stream lazily, reading only as far as the consumer pulls
+    :param source: file object with a read method, or an iterator of byte chunks of any size
+    :param level: zlib compression level
+    :return: generator of compressed chunks of any size, together one zlib stream
+    """
+    compressor = zlib.compressobj(level)
+    for chunk in utils.iter_chunks(source, READ_SIZE):
+        compressed = compressor.compress(as_buffer(chunk))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+# endregion Helper Functions
+
+
+class DecompressingWriter(object):
+    """
+    Inflates a compressed stream on its way into another writer. The stream has to arrive in order, so frames are
+    never written at their own offsets.
+    """
+    random_access = False
+
+    def __init__(self, writer):
+        """
+        Create a DecompressingWriter
+        :param writer: OutputWriter or MappedWriter the inflated stream goes to
+        """
+        self.writer = writer
+        self.decompressor = zlib.decompressobj()
+        self.compressed = 0  # bytes taken in, before inflating
+
+    @property
+    def written(self):
+        return self.writer.written
+
+    def write(self, data):
+        self.compressed += len(data)
+        inflated = self.decompressor.decompress(as_buffer(data))
+        if inflated:
+            self.writer.write(inflated)
+
+    def close(self):
+        """
+        Write whatever the decompressor still holds, then close the writer underneath
+        :return:
+        """
+        remaining = self.decompressor.flush()
+        if remaining:
+            self.writer.write(remaining)
+        self.writer.close()
@@ -0,0 +1,159 @@
+class TokenBucketPacer(object):
+    """
+    Token bucket that spaces frames out at a given rate, allowing short bursts of up to burst frames
+    """
+
+    def __init__(self, rate=None, burst=4):
+        """
+        Create a TokenBucketPacer
+        :param rate: frames per second, or None to send without pacing
+        :param burst: maximum number of tokens that can build up while idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = None
+
+    def refill(self, now):
+        """
+        (INTERNAL) Add the tokens earned since the last call
+        :param now: current time, in seconds
+        :return:
+        """
+        if self.last is not None and self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, now):
+        """
+        Take a token if one is available
+        :param now: current time, in seconds
+        :return: 0 if a frame may go now, otherwise seconds until the next token
+        """
+        if self.rate is None:
+            return 0
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class CongestionController(object):
+    """
+    Fixed window with no pacing. Subclasses size the window and the pacing rate from ACK and timeout signals.
+    """
+
+    def __init__(self, max_window):
+        """
+        Create a CongestionController
+        :param max_window: largest number of frames allowed in flight
+        """
+        self.max_window = max_window
+        self.pacer = TokenBucketPacer()
+
+    @property
+    def window(self):
+        """
+        Number of frames allowed in flight right now
+        """
+        return self.max_window
+
+    def on_ack(self, acked, now, srtt):
+        """
+        Frames were acknowledged
+        :param acked: number of frames newly acknowledged
+        :param now: current time, in seconds
+        :param srtt: smoothed round trip time, or None before the first sample
+        :return:
+        """
+        pass
+
+    def on_loss(self, lost, now, srtt):
+        """
+        Retransmission timers expired
+        :param lost: number of frames whose timer expired
+        :param now: current time, in seconds
+        :param srtt: smoothed round trip time, or None before the first sample
+        :return:
+        """
+        pass
+
+    def pace(self, now):
+        """
+        Ask to put one new frame on the channel
+        :param now: current time, in seconds
+        :return: 0 if the frame may go now, otherwise seconds to wait
+        """
+        return self.pacer.delay(now)
+
+
+class AimdController(CongestionController):
+    """
+    Additive increase, multiplicative decrease with slow start. The channel drops frames at random whatever the
+    sending rate, so the window is only cut when the smoothed loss rate rises above loss_tolerance, which is what
+    overflowing the receiver's socket buffer looks like. The pacer spreads a window over one smoothed RTT.
+    """
+
+    def __init__(self, max_window, initial_window=8, min_window=2, loss_tolerance=0.05, loss_gain=1.0 / 64,
+                 pacing_gain=2.0):
+        """
+        Create an AimdController
+        :param max_window: largest number of frames allowed in flight
+        :param initial_window: window before any ACK arrives
+        :param min_window: the window is never cut below this
+        :param loss_tolerance: smoothed loss rate the channel is expected to cause on its own
+        :param loss_gain: weight of each frame's outcome in the smoothed loss rate
+        :param pacing_gain: pacing rate as a multiple of window / srtt, above 1 so pacing never limits a full window
+        """
+        super(AimdController, self).__init__(max_window)
+        self.cwnd = float(min(initial_window, max_window))
+        self.ssthresh = float(max_window)
+        self.min_window = min_window
+        self.loss_tolerance = loss_tolerance
+        self.loss_gain = loss_gain
+        self.pacing_gain = pacing_gain
+        self.loss_rate = 0.0
+        self.last_decrease = None
+
+    @property
+    def window(self):
+        return max(self.min_window, min(self.max_window, int(self.cwnd)))
+
+    def record(self, count, lost):
+        """
+        (INTERNAL) Fold count frame outcomes into the smoothed loss rate at once
+        :param count: number of frames
+        :param lost: whether those frames were lost
+        :return:
+        """
+        keep = (1 - self.loss_gain) ** count
+        self.loss_rate = self.loss_rate * keep + (1 - keep if lost else 0)
+
+    def update_pacing(self, srtt):
+        """
+        (INTERNAL) Set the pacer to send one window per srtt, scaled by pacing_gain
+        :param srtt: smoothed round trip time, or None before the first sample
+        :return:
+        """
+        if srtt:
+            self.pacer.rate = self.pacing_gain * self.window / srtt
+
+    def on_ack(self, acked, now, srtt):
+        self.record(acked, False)
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked  # slow start
+        else:
+            self.cwnd += float(acked) / self.cwnd  # one frame per window of ACKs
+        self.cwnd = min(self.cwnd, self.max_window)
+        self.update_pacing(srtt)
+
+    def on_loss(self, lost, now, srtt):
+        self.record(lost, True)
+        # Cut at most once per round trip, and only when losses exceed what the channel causes by itself
+        recently_cut = self.last_decrease is not None and srtt is not None and now - self.last_decrease < srtt
+        if self.loss_rate > self.loss_tolerance and not recently_cut:
+            self.ssthresh = max(self.min_window, self.cwnd / 2)
+            self.cwnd = self.ssthresh
+            self.last_decrease = now
+        self.update_pacing(srtt)
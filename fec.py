@@ -0,0 +1,213 @@
+from collections import OrderedDict
+
+import header
+from intcodec import bytes_to_int, int_to_bytes
+
+# region Constants
+
+MAX_GROUP_SIZE = 32
+MIN_GROUP_SIZE = 2
+MIN_LOSS_RATE = 0.001  # below this, parity costs more than the retransmissions it saves
+# endregion Constants
+
+# region Helper Functions
+
+
+def group_size_for(loss_rate):
+    """
+    Pick how many data frames one parity frame protects. A group of k frames plus parity is rebuilt when at most
+    one of them is lost, so aiming for about one loss per four groups keeps most losses recoverable while the
+    overhead stays at 1 / k.
+    :param loss_rate: observed fraction of frames lost
+    :return: group size, or None to send no parity at all
+    """
+    if loss_rate < MIN_LOSS_RATE:
+        return None
+    return max(MIN_GROUP_SIZE, min(MAX_GROUP_SIZE, int(1 / (4 * loss_rate))))
+
+
+def padded_int(payload, payload_size):
+    """
+    Read a payload zero-padded to payload_size as one integer, so payloads can be XORed in bulk
+    :param payload: payload bytes
+    :param payload_size: padded length
+    :return: int
+    """
+    return bytes_to_int(payload) << (8 * (payload_size - len(payload)))
+# endregion Helper Functions
+
+
+class ParityEncoder(object):
+    """
+    XORs consecutive data payloads together and emits one parity payload per group
+    """
+
+    def __init__(self, payload_size, group_size=None):
+        """
+        Create a ParityEncoder
+        :param payload_size: largest data payload, which is also the size of the XOR block
+        :param group_size: data frames per parity frame, or None to send no parity
+        """
+        self.payload_size = payload_size
+        self.group_size = group_size
+        self.first = None
+        self.count = 0
+        self.lengths = 0
+        self.parity = 0
+
+    def set_loss_rate(self, loss_rate):
+        """
+        Adapt the parity ratio to the loss rate the receiver reports. Takes effect from the next group.
+        :param loss_rate: fraction of frames lost
+        :return:
+        """
+        self.group_size = group_size_for(loss_rate)
+
+    def add(self, seq, payload):
+        """
+        Add a data payload sent for the first time
+        :param seq: packet number of the data frame
+        :param payload: data payload
+        :return: (first packet number, parity payload) once the group is full, otherwise None
+        """
+        if self.group_size is None and not self.count:
+            return None
+        if not self.count:
+            self.first = seq
+        self.count += 1
+        self.lengths ^= len(payload)
+        self.parity ^= padded_int(payload, self.payload_size)
+        if self.group_size is None or self.count >= self.group_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        Close the current group early, e.g. at the end of the stream
+        :return: (first packet number, parity payload), or None if the group is empty
+        """
+        if not self.count:
+            return None
+        parity = header.PARITY_HEADER.pack(self.count, self.lengths) + bytes(int_to_bytes(self.parity, self.payload_size))
+        group = (self.first, bytearray(parity))
+        self.first = None
+        self.count = 0
+        self.lengths = 0
+        self.parity = 0
+        return group
+
+
+class ParityDecoder(object):
+    """
+    Remembers recent payloads and rebuilds the one missing frame of any group whose parity has arrived
+    """
+
+    def __init__(self, payload_size, sequence_space=header.SEQUENCE_SPACE, history=256, max_groups=16):
+        """
+        Create a ParityDecoder
+        :param payload_size: largest data payload, which is also the size of the XOR block
+        :param sequence_space: number of distinct packet numbers
+        :param history: number of recent payloads remembered; at most half the sequence space, so a packet
+            number always refers to the most recent frame that used it
+        :param max_groups: parity groups kept waiting for their frames before the oldest is given up
+        """
+        self.payload_size = payload_size
+        self.sequence_space = sequence_space
+        self.history = min(history, sequence_space // 2)
+        self.max_groups = max_groups
+        self.payloads = OrderedDict()  # packet number -> payload, oldest first
+        self.groups = OrderedDict()  # first packet number -> (count, lengths, parity)
+
+    def add_data(self, seq, payload):
+        """
+        Remember a data payload the receiver accepted
+        :param seq: packet number
+        :param payload: data payload
+        :return: list of (packet number, payload) frames this made recoverable
+        """
+        self.remember(seq, payload)
+        return self.recover()
+
+    def add_parity(self, first, parity):
+        """
+        Take a parity payload
+        :param first: packet number of the first data frame in the group
+        :param parity: parity payload built by ParityEncoder
+        :return: list of (packet number, payload) frames this made recoverable
+        """
+        if len(parity) != header.PARITY_HEADER.size + self.payload_size:
+            return []
+        count, lengths = header.PARITY_HEADER.unpack_from(bytes(parity[:header.PARITY_HEADER.size]))
+        self.groups[first] = (count, lengths, bytes_to_int(parity[header.PARITY_HEADER.size:]))
+        while len(self.groups) > self.max_groups:
+            self.groups.popitem(last=False)
+        return self.recover()
+
+    def remember(self, seq, payload):
+        """
+        (INTERNAL) Store a payload as the newest one, forgetting the oldest beyond history
+        """
+        self.payloads.pop(seq, None)
+        self.payloads[seq] = payload
+        while len(self.payloads) > self.history:
+            self.payloads.popitem(last=False)
+
+    def recover(self):
+        """
+        (INTERNAL) Rebuild every frame that is the only one missing from a group with parity
+        :return: list of (packet number, payload)
+        """
+        recovered = []
+        for first, (count, lengths, parity) in list(self.groups.items()):
+            members = [(first + i) % self.sequence_space for i in range(count)]
+            missing = [seq for seq in members if seq not in self.payloads]
+            if len(missing) > 1:
+                continue
+            del self.groups[first]
+            if not missing:
+                continue
+            for seq in members:
+                if seq != missing[0]:
+                    lengths ^= len(self.payloads[seq])
+                    parity ^= padded_int(self.payloads[seq], self.payload_size)
+            if lengths > self.payload_size:
+                continue  # parity and data disagree, so some frame was from an older group
+            payload = int_to_bytes(parity, self.payload_size)[:lengths]
+            self.remember(missing[0], payload)
+            recovered.append((missing[0], payload))
+        return recovered
+
+
+class LossEstimator(object):
+    """
+    Smoothed fraction of frames lost, judged from the gaps in packet numbers as new frames arrive
+    """
+
+    def __init__(self, sequence_space=header.SEQUENCE_SPACE, gain=1.0 / 64):
+        """
+        Create a LossEstimator
+        :param sequence_space: number of distinct packet numbers
+        :param gain: weight of each frame's outcome in the smoothed loss rate
+        """
+        self.sequence_space = sequence_space
+        self.gain = gain
+        self.highest = None
+        self.loss_rate = 0.0
+
+    def observe(self, seq):
+        """
+        Record a valid data frame
+        :param seq: its packet number
+        :return:
+        """
+        if self.highest is None:
+            self.highest = seq
+            return
+        gap = (seq - self.highest) % self.sequence_space
+        if not 0 < gap < self.sequence_space // 2:
+            return  # a retransmission or a late frame, which says nothing new about loss
+        self.highest = seq
+        # gap - 1 frames were skipped, then this one arrived
+        keep = (1 - self.gain) ** (gap - 1)
+        self.loss_rate = self.loss_rate * keep + (1 - keep)
+        self.loss_rate *= 1 - self.gain
@@ -0,0 +1,46 @@
+class FramePool(object):
+    """
+    Free list of fixed-size frame buffers. Frames are built in place at the start of a buffer, and the buffer goes
+    back on the list once its frame is acknowledged, so a steady stream of frames reuses the same few buffers.
+    """
+
+    def __init__(self, buffer_size, capacity=0):
+        """
+        Create a FramePool
+        :param buffer_size: bytes per buffer, at least the largest frame
+        :param capacity: buffers allocated up front
+        """
+        self.buffer_size = buffer_size
+        self.free = [bytearray(buffer_size) for _ in range(capacity)]
+        self.allocations = 0  # buffers created because the list ran dry, beyond the capacity allocated up front
+        self.acquired = 0  # buffers handed out, one per frame built
+
+    def acquire(self):
+        """
+        Take a buffer, allocating a new one only if none is free
+        :return: bytearray of buffer_size bytes with unspecified contents
+        """
+        self.acquired += 1
+        if self.free:
+            return self.free.pop()
+        self.allocations += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        """
+        Hand a buffer back once nothing refers to the frame inside it
+        :param buffer: bytearray from acquire
+        :return:
+        """
+        self.free.append(buffer)
+
+    @property
+    def allocations_per_frame(self):
+        """
+        Buffers allocated on demand per buffer handed out, zero when the pool covers the window
+        """
+        return float(self.allocations) / self.acquired if self.acquired else 0.0
+
+    def __repr__(self):
+        return "FramePool(acquired={}, allocations={}, {:.4f} per frame)".format(
+            self.acquired, self.allocations, self.allocations_per_frame)
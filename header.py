@@ -0,0 +1,246 @@
+import struct
+
+import checksum
+from channelsimulator import ChannelSimulator
+
+# region Constants
+
+VERSION = 1
+# checksum, version, flags, payload length, sequence number. The checksum comes first so it can cover
+# everything after it, header included.
+HEADER = struct.Struct("!IBBHI")
+HEADER_SIZE = HEADER.size
+CHECKSUM_SIZE = 4
+SEQUENCE_SPACE = 2 ** 32
+
+FLAG_PARITY = 0x01  # payload is fec parity over the group starting at the sequence number
+FLAG_ACK = 0x02  # payload is an acknowledgement
+FLAG_COMPRESSED = 0x04  # frame belongs to a transfer whose stream is zlib compressed
+FLAG_SYN = 0x08  # opens a transfer at the initial sequence number; payload is SYN_PAYLOAD
+FLAG_FIN = 0x10  # closes a transfer; the sequence number is the one after its last data frame
+FLAG_NAK = 0x20  # payload lists ranges of frames the receiver found missing or corrupted, as NAK_RANGE entries
+FLAG_MESSAGES = 0x40  # on a SYN: the transfer is a message stream, whose frames may be short before the last one
+
+# Options a SYN carries along with the flags: total length of the stream, or UNKNOWN_LENGTH, and the sender's window
+SYN_PAYLOAD = struct.Struct("!QH")
+UNKNOWN_LENGTH = 2 ** 64 - 1
+# One range of a NAK: offset of its first frame from the sequence number of the NAK, and its number of frames
+NAK_RANGE = struct.Struct("!HH")
+PARITY_HEADER = struct.Struct("!BH")  # leads a parity payload: number of frames covered, XOR of their payload lengths
+BUFFER_SIZE = ChannelSimulator.BUFFER_SIZE  # largest frame the channel carries
+# endregion Constants
+
+
+def encode_into(frame, seq, flags, payload_length, algorithm=checksum.DEFAULT_ALGORITHM):
+    """
+    Write the header into a frame whose payload is already in place after HEADER_SIZE bytes
+    :param frame: bytearray of at least HEADER_SIZE + payload_length bytes; bytes past the frame are not covered
+    :param seq: sequence number, taken modulo SEQUENCE_SPACE
+    :param flags: bitwise OR of the FLAG_ constants
+    :param payload_length: number of payload bytes
+    :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+    :return:
+    """
+    seq %= SEQUENCE_SPACE
+    HEADER.pack_into(frame, 0, 0, VERSION, flags, payload_length, seq)
+    value = checksum.compute(frame, algorithm, CHECKSUM_SIZE, HEADER_SIZE + payload_length)
+    HEADER.pack_into(frame, 0, value, VERSION, flags, payload_length, seq)
+
+
+def pack_into(buffer, seq, payload, flags=0, algorithm=checksum.DEFAULT_ALGORITHM):
+    """
+    Build a frame in place at the start of a reusable buffer
+    :param buffer: bytearray of at least HEADER_SIZE + len(payload) bytes
+    :param seq: sequence number, taken modulo SEQUENCE_SPACE
+    :param payload: payload bytes, copied in after the header
+    :param flags: bitwise OR of the FLAG_ constants
+    :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+    :return: memoryview of the frame, valid until the buffer is reused
+    """
+    length = len(payload)
+    buffer[HEADER_SIZE:HEADER_SIZE + length] = payload
+    encode_into(buffer, seq, flags, length, algorithm)
+    return memoryview(buffer)[:HEADER_SIZE + length]
+
+
+def encode(seq, payload, flags=0, algorithm=checksum.DEFAULT_ALGORITHM):
+    """
+    Build a frame
+    :param seq: sequence number, taken modulo SEQUENCE_SPACE
+    :param payload: payload bytes
+    :param flags: bitwise OR of the FLAG_ constants
+    :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+    :return: bytearray laid out as [checksum, version, flags, length, seq, payload...]
+    """
+    frame = bytearray(HEADER_SIZE + len(payload))
+    pack_into(frame, seq, payload, flags, algorithm)
+    return frame
+
+
+def decode(frame, algorithm=checksum.DEFAULT_ALGORITHM):
+    """
+    Check and parse a frame
+    :param frame: bytearray received from the channel
+    :param algorithm: checksum algorithm the frame was built with
+    :return: (seq, flags, payload), or None if the frame is short, from another version or fails its checksum
+    """
+    if frame is None or len(frame) < HEADER_SIZE:
+        return None
+    expected, version, flags, length, seq = HEADER.unpack_from(frame)
+    if version != VERSION or HEADER_SIZE + length != len(frame):
+        return None
+    if checksum.compute(frame, algorithm, CHECKSUM_SIZE) != expected:
+        return None
+    return seq, flags, frame[HEADER_SIZE:]
+
+
+class DataGram(object):
+    HEADER_SIZE = HEADER_SIZE
+    # Data payloads leave room for the parity header, so a parity frame over full payloads still fits one buffer
+    PAYLOAD_SIZE = BUFFER_SIZE - HEADER_SIZE - PARITY_HEADER.size
+    FLAG_PARITY = FLAG_PARITY
+    FLAG_ACK = FLAG_ACK
+    FLAG_COMPRESSED = FLAG_COMPRESSED
+    FLAG_SYN = FLAG_SYN
+    FLAG_FIN = FLAG_FIN
+    FLAG_NAK = FLAG_NAK
+    FLAG_MESSAGES = FLAG_MESSAGES
+
+    def __init__(self, data, packetNum, algorithm=checksum.DEFAULT_ALGORITHM, flags=0):
+        """
+        :param data: data inside the packet
+        :param packetNUM: number of the packet being sent
+        :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+        :param flags: bitwise OR of the FLAG_ constants
+        """
+        self.data = data
+        self.packet_num = packetNum
+        self.algorithm = algorithm
+        self.flags = flags
+
+    def to_bytes(self):
+        """
+        Build the frame sent through the channel, with the header laid out by HEADER
+        :return: bytearray
+        """
+        return encode(self.packet_num, self.data, self.flags, self.algorithm)
+
+    @staticmethod
+    def from_bytes(frame, algorithm=checksum.DEFAULT_ALGORITHM):
+        """
+        Parse a frame received from the channel
+        :param frame: bytearray built by to_bytes
+        :param algorithm: checksum algorithm the frame was built with
+        :return: DataGram, or None if the frame is malformed or fails its checksum
+        """
+        decoded = decode(frame, algorithm)
+        if decoded is None:
+            return None
+        packet_num, flags, data = decoded
+        return DataGram(data, packet_num, algorithm, flags)
+
+
+class Ack(object):
+    # loss rate byte plus one bitmap bit per frame of the window must fit one buffer
+    MAX_WINDOW = 8 * (BUFFER_SIZE - HEADER_SIZE - 1)
+
+    def __init__(self, cumulative, selective=(), window_size=64, algorithm=checksum.DEFAULT_ALGORITHM, loss_rate=0.0):
+        """
+        :param cumulative: packet number of the next frame the receiver expects
+        :param selective: offsets k >= 1 such that frame cumulative + k has already been received
+        :param window_size: receive window, which sets the size of the selective-ack bitmap
+        :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+        :param loss_rate: fraction of frames the receiver sees lost, carried in steps of 1/1000 up to 0.255
+        """
+        self.cumulative = cumulative
+        self.selective = list(selective)
+        self.window_size = window_size
+        self.algorithm = algorithm
+        self.loss_rate = loss_rate
+
+    def to_bytes(self):
+        """
+        Build the ACK frame: a DataGram flagged FLAG_ACK whose packet number is the cumulative ACK and whose payload
+        is the loss rate byte followed by a bitmap with bit k - 1 set when frame cumulative + k has been received
+        :return: bytearray to send through the channel
+        """
+        payload = bytearray(1 + (self.window_size + 7) // 8)
+        payload[0] = min(255, int(round(self.loss_rate * 1000)))
+        for offset in self.selective:
+            payload[1 + (offset - 1) // 8] |= 1 << ((offset - 1) % 8)
+        return DataGram(payload, self.cumulative, self.algorithm, DataGram.FLAG_ACK).to_bytes()
+
+    @staticmethod
+    def from_bytes(frame, algorithm=checksum.DEFAULT_ALGORITHM):
+        """
+        Parse an ACK frame received from the channel
+        :param frame: bytearray built by Ack.to_bytes
+        :param algorithm: checksum algorithm the frame was built with
+        :return: Ack, or None if the frame fails its checksum or is not an ACK
+        """
+        return Ack.from_datagram(DataGram.from_bytes(frame, algorithm))
+
+    @staticmethod
+    def from_datagram(datagram):
+        """
+        :param datagram: DataGram parsed from an ACK frame, or None
+        :return: Ack, or None if there is no datagram or it is not an ACK
+        """
+        if datagram is None or datagram.flags != DataGram.FLAG_ACK or not datagram.data:
+            return None
+        bitmap = datagram.data[1:]
+        selective = [i + 1 for i in range(len(bitmap) * 8) if bitmap[i // 8] & (1 << (i % 8))]
+        return Ack(datagram.packet_num, selective, len(bitmap) * 8, datagram.algorithm, datagram.data[0] / 1000.0)
+
+
+class Nak(object):
+    MAX_RANGES = (BUFFER_SIZE - HEADER_SIZE) // NAK_RANGE.size
+
+    def __init__(self, ranges, algorithm=checksum.DEFAULT_ALGORITHM):
+        """
+        :param ranges: (first packet number, count) of every run of frames the receiver found missing or corrupted,
+            oldest first and all within 2 ** 16 frames of the first
+        :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+        """
+        self.ranges = list(ranges)
+        self.algorithm = algorithm
+
+    @staticmethod
+    def from_packets(packet_nums, algorithm=checksum.DEFAULT_ALGORITHM):
+        """
+        :param packet_nums: packet numbers of the missing frames, oldest first
+        :param algorithm: checksum algorithm, one of checksum.ALGORITHMS
+        :return: Nak for the runs of consecutive packet numbers, the oldest MAX_RANGES of them
+        """
+        ranges = []
+        for packet_num in packet_nums:
+            if ranges and (ranges[-1][0] + ranges[-1][1]) % SEQUENCE_SPACE == packet_num:
+                ranges[-1][1] += 1
+            elif len(ranges) < Nak.MAX_RANGES:
+                ranges.append([packet_num, 1])
+        return Nak([tuple(r) for r in ranges], algorithm)
+
+    def to_bytes(self):
+        """
+        Build the NAK frame: a DataGram flagged FLAG_NAK numbered after the first missing frame, whose payload is
+        one NAK_RANGE per range
+        :return: bytearray to send through the channel
+        """
+        first = self.ranges[0][0]
+        payload = b''.join(NAK_RANGE.pack((packet_num - first) % SEQUENCE_SPACE, count)
+                           for packet_num, count in self.ranges)
+        return DataGram(payload, first, self.algorithm, DataGram.FLAG_NAK).to_bytes()
+
+    @staticmethod
+    def from_datagram(datagram):
+        """
+        :param datagram: DataGram parsed from a NAK frame, or None
+        :return: Nak, or None if there is no datagram or it is not a well-formed NAK
+        """
+        if datagram is None or datagram.flags != DataGram.FLAG_NAK or not datagram.data \
+                or len(datagram.data) % NAK_RANGE.size:
+            return None
+        data = bytes(datagram.data)
+        ranges = [NAK_RANGE.unpack_from(data, i) for i in range(0, len(data), NAK_RANGE.size)]
+        return Nak([((datagram.packet_num + offset) % SEQUENCE_SPACE, count) for offset, count in ranges],
+                   datagram.algorithm)
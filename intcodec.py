@@ -0,0 +1,37 @@
+"""
+Conversions between byte strings and whole integers, done in C so callers can XOR or reduce a buffer in one
+operation instead of looping over its bytes in Python
+"""
+import binascii
+
+# region Helper Functions
+
+
+def bytes_to_int(data_bytes, byteorder="big"):
+    """
+    Read bytes as one integer
+    :param data_bytes: bytes, bytearray or memoryview
+    :param byteorder: "big" or "little"
+    :return: int
+    """
+    try:
+        return int.from_bytes(data_bytes, byteorder)
+    except AttributeError:
+        # Python 2 has no int.from_bytes, so go through hex instead
+        data_bytes = bytearray(data_bytes)
+        if byteorder == "little":
+            data_bytes.reverse()
+        return int(binascii.hexlify(data_bytes) or b"0", 16)
+
+
+def int_to_bytes(value, n):
+    """
+    Write an integer as n big-endian bytes
+    :param value: non-negative int below 256 ** n
+    :param n: number of bytes
+    :return: bytearray of length n
+    """
+    if not n:
+        return bytearray()
+    return bytearray(binascii.unhexlify("{:0{}x}".format(value, 2 * n)))
+# endregion Helper Functions
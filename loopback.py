@@ -0,0 +1,252 @@
+"""
+In-process channel: endpoints in one process exchange frames through in-memory queues instead of UDP sockets,
+with the same corruption as ChannelSimulator. Seed a channel to repeat its errors exactly, or record the channel
+events of one run in a ChannelTrace and replay them in another.
+"""
+import binascii
+import json
+import logging
+import socket
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from channelsimulator import ChannelSimulator
+
+
+class LoopbackSocket(object):
+    """
+    Queue of datagrams bound to one port, with the timeout behaviour of a UDP socket
+    """
+
+    def __init__(self):
+        """
+        Create a LoopbackSocket
+        """
+        self.queue = Queue.Queue()
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recv(self):
+        """
+        Take the next datagram, waiting up to the timeout for one to arrive
+        :return: bytearray; raises socket.timeout if nothing arrives in time
+        """
+        try:
+            return self.queue.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise socket.timeout("timed out")
+
+
+class LoopbackNetwork(object):
+    """
+    Ports of the in-process channels that can reach each other
+    """
+
+    def __init__(self):
+        """
+        Create a LoopbackNetwork
+        """
+        self.sockets = dict()  # port -> LoopbackSocket
+
+    def bind(self, port):
+        """
+        Start listening on a port
+        :param port: port number
+        :return: LoopbackSocket bound to port
+        """
+        if port in self.sockets:
+            raise socket.error("port {} is already bound".format(port))
+        self.sockets[port] = LoopbackSocket()
+        return self.sockets[port]
+
+    def close(self, port):
+        """
+        Stop listening on a port, dropping anything still queued there
+        :param port: port number
+        :return:
+        """
+        self.sockets.pop(port, None)
+
+    def deliver(self, port, data_bytes):
+        """
+        Queue a datagram on a port. As with UDP, datagrams for a port nobody listens on are lost.
+        :param port: destination port
+        :param data_bytes: datagram, copied so the caller may reuse its buffer
+        :return:
+        """
+        destination = self.sockets.get(port)
+        if destination is not None:
+            destination.queue.put(bytearray(data_bytes))
+
+
+NETWORK = LoopbackNetwork()  # shared by every channel that is not given its own
+
+
+def hexlify(data):
+    """
+    (INTERNAL) Frame as a hex string for JSON
+    :param data: bytearray
+    :return: str
+    """
+    return binascii.hexlify(bytes(data)).decode("ascii")
+
+
+class ChannelTrace(object):
+    """
+    Per-frame channel events, in the (is_drop, mask, swap_end) form ChannelSimulator.draw_events returns, and the
+    random filler frames the swap queue starts with and is refilled with after every drop. Swaps deliver those
+    fillers, so a replay needs them as much as the events.
+    """
+
+    def __init__(self, events=None, fillers=None):
+        """
+        Create a ChannelTrace
+        :param events: events to replay, empty to start a recording
+        :param fillers: filler frames to replay, in the order the channel took them
+        """
+        self.events = list(events or ())
+        self.fillers = list(fillers or ())
+        self.position = 0  # next event to replay
+        self.filler_position = 0  # next filler frame to replay
+
+    def append(self, event):
+        self.events.append(event)
+
+    def append_filler(self, frame):
+        self.fillers.append(bytearray(frame))
+
+    def next_filler(self):
+        """
+        Take the next recorded filler frame
+        :return: copy of the frame, or None once the trace runs out
+        """
+        if self.filler_position >= len(self.fillers):
+            return None
+        self.filler_position += 1
+        return bytearray(self.fillers[self.filler_position - 1])
+
+    def next_event(self, n):
+        """
+        Take the next recorded event, fitted to the length of the current frame
+        :param n: length of the frame
+        :return: (is_drop, mask, swap_end); once the trace runs out, frames pass untouched
+        """
+        if self.position >= len(self.events):
+            return False, None, None
+        is_drop, mask, swap_end = self.events[self.position]
+        self.position += 1
+        if mask is not None:
+            # a frame of another length than the recorded one is corrupted over the bytes both have in common
+            mask = bytearray(mask[:n]) + bytearray(n - len(mask[:n]))
+        return is_drop, mask, swap_end
+
+    def save(self, path):
+        """
+        Write the trace as JSON
+        :param path: file to write
+        :return:
+        """
+        with open(path, "w") as f:
+            json.dump({
+                "events": [[is_drop, None if mask is None else hexlify(mask), swap_end]
+                           for is_drop, mask, swap_end in self.events],
+                "fillers": [hexlify(frame) for frame in self.fillers],
+            }, f)
+
+    @staticmethod
+    def load(path):
+        """
+        Read a trace written by save
+        :param path: file to read
+        :return: ChannelTrace positioned at its first event
+        """
+        with open(path) as f:
+            trace = json.load(f)
+        return ChannelTrace(((is_drop, None if mask is None else bytearray(binascii.unhexlify(mask)), swap_end)
+                             for is_drop, mask, swap_end in trace["events"]),
+                            (bytearray(binascii.unhexlify(frame)) for frame in trace["fillers"]))
+
+
+class LoopbackChannel(ChannelSimulator):
+    """
+    ChannelSimulator whose frames travel through a LoopbackNetwork instead of UDP sockets. The sender and the
+    receiver each need their own channel on the same network, as with ChannelSimulator.
+    """
+
+    def __init__(self, inbound_port, outbound_port, debug_level=logging.INFO, seed=None, network=None, record=None,
+                 replay=None, drop_error_prob=0.005, random_error_prob=0.005, swap_error_prob=0.005):
+        """
+        Create a LoopbackChannel
+        :param inbound_port: port number for inbound connections
+        :param outbound_port: port number of outbound connections
+        :param debug_level: debug level for logging (e.g. logging.DEBUG)
+        :param seed: seed for every random choice the channel makes
+        :param network: LoopbackNetwork to join, the shared NETWORK by default
+        :param record: ChannelTrace every channel event is appended to
+        :param replay: ChannelTrace whose events are used instead of drawing new ones
+        :param drop_error_prob: drop frame error probability used by corrupt by default
+        :param random_error_prob: random bit error probability used by corrupt by default
+        :param swap_error_prob: swap frame error probability used by corrupt by default
+        """
+        # set first, as the swap queue is filled while the simulator is created
+        self.record = record
+        self.replay = replay
+        super(LoopbackChannel, self).__init__(inbound_port, outbound_port, debug_level, seed=seed,
+                                              drop_error_prob=drop_error_prob, random_error_prob=random_error_prob,
+                                              swap_error_prob=swap_error_prob)
+        self.network = network if network is not None else NETWORK
+
+    def sndr_setup(self, timeout):
+        pass  # sending needs no socket
+
+    def rcvr_setup(self, timeout):
+        self.rcvr_socket = self.network.bind(self.rcvr_port)
+        self.rcvr_socket.settimeout(timeout)
+
+    def close(self):
+        """
+        Release the inbound port
+        :return:
+        """
+        self.network.close(self.rcvr_port)
+
+    def put_to_socket(self, data_bytes):
+        self.network.deliver(self.sndr_port, data_bytes)
+
+    def get_from_socket(self):
+        return self.rcvr_socket.recv()
+
+    def get_batch_from_socket(self, max_frames):
+        frames = list()
+        queue = self.rcvr_socket.queue
+        try:
+            while len(frames) < max_frames:
+                frames.append(queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return frames
+
+    def filler_frame(self):
+        frame = self.replay.next_filler() if self.replay is not None else None
+        if frame is None:
+            frame = super(LoopbackChannel, self).filler_frame()
+        if self.record is not None:
+            self.record.append_filler(frame)
+        return frame
+
+    def draw_events(self, n, drop_error_prob, random_error_prob, swap_error_prob):
+        if self.replay is not None:
+            event = self.replay.next_event(n)
+        else:
+            event = super(LoopbackChannel, self).draw_events(n, drop_error_prob, random_error_prob, swap_error_prob)
+        if self.record is not None:
+            self.record.append(event)
+        return event
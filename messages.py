@@ -0,0 +1,143 @@
+"""
+Message framing for applications that send many small writes. Each message goes into the stream after its length,
+and the Coalescer packs the stream into full frames instead of sending one short frame per write. A frame that is not
+full yet goes out once it has waited FLUSH_DELAY, or when the application flushes. The Coalescer is not thread safe:
+ReliableSender only touches it with its lock held, from the application's calls and from the thread driving the
+transfer.
+"""
+import collections
+import time
+
+import utils
+
+# region Constants
+
+FLUSH_DELAY = 0.01  # seconds a frame that is not full may wait for more messages
+READ_SIZE = 64 * 1024  # bytes read from a file object per chunk when splitting a stream back into messages
+# endregion Constants
+
+# region Helper Functions
+
+
+def encode_length(n):
+    """
+    Length prefix of a message: 7 bits per byte, lowest first, with the top bit set on every byte but the last.
+    Messages below 128 bytes take one byte of overhead.
+    :param n: message length
+    :return: bytearray
+    """
+    prefix = bytearray()
+    while n >= 0x80:
+        prefix.append(n & 0x7f | 0x80)
+        n >>= 7
+    prefix.append(n)
+    return prefix
+
+
+def iter_messages(source):
+    """
+    Split a stream built from length-prefixed messages back into the messages
+    :param source: file object with a read method, or an iterator of byte chunks of any size
+    :return: generator of messages as bytes; raises ValueError if the stream ends inside a message
+    """
+    buffer = bytearray()
+    for chunk in utils.iter_chunks(source, READ_SIZE):
+        buffer += chunk
+        position = 0
+        while True:
+            length = shift = 0
+            start = position
+            while start < len(buffer) and buffer[start] & 0x80:
+                length |= (buffer[start] & 0x7f) << shift
+                shift += 7
+                start += 1
+            if start >= len(buffer):
+                break
+            length |= buffer[start] << shift
+            start += 1
+            if start + length > len(buffer):
+                break
+            yield bytes(buffer[start:start + length])
+            position = start + length
+        del buffer[:position]
+    if buffer:
+        raise ValueError("Stream ends inside a message")
+# endregion Helper Functions
+
+
+class Coalescer(object):
+    """
+    Buffer between message writes and the sender's window, in the manner of Nagle's algorithm: writes are packed
+    together and only a full frame goes out at once
+    """
+
+    def __init__(self, payload_size, flush_delay=FLUSH_DELAY):
+        """
+        Create a Coalescer
+        :param payload_size: bytes in a full frame
+        :param flush_delay: seconds a frame that is not full may wait for more messages
+        """
+        self.payload_size = payload_size
+        self.flush_delay = flush_delay
+        self.pending = bytearray()  # start of the next frame
+        self.ready = collections.deque()  # payloads waiting for room in the window
+        self.deadline = None  # time pending must go out by, None while it is empty
+        self.closed = False
+
+    def write(self, message):
+        """
+        Add one message to the stream
+        :param message: bytes, bytearray or memoryview
+        :return:
+        """
+        if self.closed:
+            raise ValueError("Write to a closed message stream")
+        if not self.pending:
+            self.deadline = time.time() + self.flush_delay
+        self.pending += encode_length(len(message))
+        self.pending += message
+        while len(self.pending) >= self.payload_size:
+            self.ready.append(bytes(self.pending[:self.payload_size]))
+            del self.pending[:self.payload_size]
+        if not self.pending:
+            self.deadline = None
+
+    def flush(self):
+        """
+        Make the frame that is not full yet ready to go without waiting for its deadline
+        :return:
+        """
+        if self.pending:
+            self.ready.append(bytes(self.pending))
+            self.pending = bytearray()
+        self.deadline = None
+
+    def close(self):
+        """
+        Flush, and end the stream once everything ready has been taken
+        :return:
+        """
+        self.flush()
+        self.closed = True
+
+    def due(self, now):
+        """
+        :param now: current time
+        :return: True if a payload is ready, or will be as soon as the sender asks for one
+        """
+        return bool(self.ready) or (self.deadline is not None and now >= self.deadline)
+
+    def payloads(self):
+        """
+        Payloads for ReliableSender.start, flushing a frame whose deadline has passed
+        :return: generator of payloads, or of an empty payload while nothing is ready, that ends once closed
+        """
+        while True:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.flush()
+            if self.ready:
+                yield self.ready.popleft()
+            elif self.closed:
+                return
+            else:
+                yield b''
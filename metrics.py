@@ -0,0 +1,134 @@
+"""
+Counters and histograms for one endpoint of a transfer. Updates are a dictionary increment, so they stay on in
+every run; the totals are turned into JSON only when they are dumped.
+"""
+import json
+import signal
+import sys
+
+# region Helper Functions
+
+
+def dump(groups, path=None):
+    """
+    Write several Metrics as one JSON object
+    :param groups: dict of name -> Metrics
+    :param path: file to write, stderr if None
+    :return:
+    """
+    report = dict((name, metrics.to_dict()) for name, metrics in groups.items())
+    if path is None:
+        json.dump(report, sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write("\n")
+    else:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def dump_on_signal(report, path=None):
+    """
+    Dump metrics whenever the process gets SIGUSR1, e.g. from kill -USR1 <pid> during a slow transfer.
+    Blocking socket calls are restarted rather than failing with EINTR. Does nothing where SIGUSR1 does not exist.
+    :param report: callable returning a dict of name -> Metrics
+    :param path: file to write, stderr if None
+    :return:
+    """
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump(report(), path))
+        signal.siginterrupt(signal.SIGUSR1, False)
+# endregion Helper Functions
+
+
+class Histogram(object):
+    """
+    Distribution of positive values in power-of-two buckets: bucket b counts values of at least 2 ** (b - 1) and
+    below 2 ** b units, and bucket 0 counts values below one unit
+    """
+
+    def __init__(self, unit=1.0):
+        """
+        Create a Histogram
+        :param unit: size of one unit, e.g. 1e-6 to bucket seconds by microseconds
+        """
+        self.unit = unit
+        self.buckets = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Record one value
+        :param value: value in the same units as unit
+        :return:
+        """
+        bucket = int(value / self.unit).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets += [0] * (bucket + 1 - len(self.buckets))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        """
+        :return: count, mean, min, max, unit and the non-empty buckets keyed by their upper bound in units
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "unit": self.unit,
+            "buckets": dict(("<{}".format(2 ** bucket), n) for bucket, n in enumerate(self.buckets) if n),
+        }
+
+
+class Metrics(object):
+    """
+    Named counters and histograms
+    """
+
+    def __init__(self):
+        """
+        Create a Metrics
+        """
+        self.counters = dict()
+        self.histograms = dict()
+
+    def count(self, name, n=1):
+        """
+        Add to a counter, creating it at zero on first use
+        :param name: counter name
+        :param n: amount to add
+        :return:
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def __getitem__(self, name):
+        return self.counters.get(name, 0)
+
+    def histogram(self, name, unit=1.0):
+        """
+        Get a histogram, creating it on first use
+        :param name: histogram name
+        :param unit: bucket unit, used only when the histogram is created
+        :return: Histogram
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(unit)
+        return histogram
+
+    def to_dict(self):
+        """
+        :return: dict of counters and histograms, ready for json.dump
+        """
+        return {
+            "counters": dict(self.counters),
+            "histograms": dict((name, histogram.to_dict()) for name, histogram in self.histograms.items()),
+        }
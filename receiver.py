@@ -1,21 +1,40 @@
 # Written by S. Mevawala, modified by D. Gitzel
 
+import argparse
+import functools
 import logging
+import mmap
+import threading
+import time
 
 import channelsimulator
+import checksum
+import compression
+import fec
+import header
+import metrics
 import utils
 import sys
 import socket
 
+try:
+	import Queue
+except ImportError:
+	import queue as Queue
+
+from header import Ack, DataGram, Nak
+
 class Receiver(object):
 
-	def __init__(self, inbound_port=50005, outbound_port=50006, timeout=10, debug_level=logging.INFO):
+	def __init__(self, inbound_port=50005, outbound_port=50006, timeout=10, debug_level=logging.INFO, simulator=None):
 		self.logger = utils.Logger(self.__class__.__name__, debug_level)
 
 		self.inbound_port = inbound_port
 		self.outbound_port = outbound_port
-		self.simulator = channelsimulator.ChannelSimulator(inbound_port=inbound_port, outbound_port=outbound_port,
-														   debug_level=debug_level)
+		if simulator is None:
+			simulator = channelsimulator.ChannelSimulator(inbound_port=inbound_port, outbound_port=outbound_port,
+														  debug_level=debug_level)
+		self.simulator = simulator
 		self.simulator.rcvr_setup(timeout)
 		self.simulator.sndr_setup(timeout)
 
@@ -30,72 +49,450 @@ class BogoReceiver(Receiver):
 		super(BogoReceiver, self).__init__()
 
 	def receive(self):
-		self.logger.info("Receiving on port: {} and replying with ACK on port: {}".format(self.inbound_port, self.outbound_port))
+		self.logger.info("Receiving on port: %s and replying with ACK on port: %s", self.inbound_port, self.outbound_port)
 		while True:
 			try:
 				data = self.simulator.u_receive()  # receive data
-				self.logger.info("Got data from socket: {}".format(data.decode('ascii')))  # note that ASCII will only decode bytes in the range 0-127
+				self.logger.debug("Got data from socket: %s", data)
 				sys.stdout.write(data)
 				self.simulator.u_send(BogoReceiver.ACK_DATA)  # send ACK
 			except socket.timeout:
 				sys.exit()
 
+class OutputWriter(object):
+	random_access = False
+
+	def __init__(self, stream, buffer_size = 256 * 1024, threaded = False):
+		'''
+		gathers in-order payloads and writes them out in large blocks
+		:param stream: binary file object to write to
+		:param buffer_size: number of bytes gathered before a block is written
+		:param threaded: hand blocks to a writer thread so a slow stream does not hold up the receive loop
+		'''
+		self.stream = stream
+		self.buffer_size = buffer_size
+		self.chunks = []
+		self.pending = 0  # bytes gathered in chunks
+		self.written = 0  # bytes handed to the stream or the writer thread
+		self.queue = None
+		self.thread = None
+		if threaded:
+			self.queue = Queue.Queue(maxsize=4)  # bounds how far the receive loop can run ahead of the stream
+			self.thread = threading.Thread(target=self.drain)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def write(self, data):
+		self.chunks.append(data)
+		self.pending += len(data)
+		if self.pending >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		'''
+		writes everything gathered so far as one block
+		'''
+		if not self.chunks:
+			return
+		block = bytearray().join(self.chunks)
+		self.chunks = []
+		self.pending = 0
+		self.written += len(block)
+		if self.queue is not None:
+			self.queue.put(block)
+		else:
+			self.stream.write(block)
+			self.stream.flush()
+
+	def close(self):
+		'''
+		flushes the last block and waits for the writer thread to finish with it
+		'''
+		self.flush()
+		if self.thread is not None:
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+
+	def drain(self):
+		'''
+		(INTERNAL) writer thread loop: write blocks until close() sends None
+		'''
+		while True:
+			block = self.queue.get()
+			if block is None:
+				self.stream.flush()
+				return
+			self.stream.write(block)
+
+
+class MappedWriter(object):
+	random_access = True
+
+	def __init__(self, path, size = 0, grow_size = 1024 * 1024):
+		'''
+		writes payloads at their own offsets in a memory-mapped output file, so frames that arrive out of order go
+		straight to the file instead of waiting in memory for the frames before them
+		:param path: file to create, replacing any file already there
+		:param size: bytes to preallocate, e.g. the total length once it is known
+		:param grow_size: bytes the file grows by at least whenever a write lands past its end
+		'''
+		self.file = open(path, 'w+b')
+		self.grow_size = grow_size
+		self.written = 0  # end of the furthest write, which becomes the length of the file on close
+		self.file.truncate(max(size, grow_size))  # an empty file cannot be mapped
+		self.mapping = mmap.mmap(self.file.fileno(), 0)
+
+	def reserve(self, size):
+		'''
+		grows the file to at least size bytes. The file is extended and mapped again rather than through
+		mmap.resize, which fails where there is no mremap, as on macOS
+		:param size: bytes the file must hold
+		'''
+		if size > len(self.mapping):
+			self.mapping.close()
+			self.file.truncate(size)
+			self.mapping = mmap.mmap(self.file.fileno(), 0)
+
+	def write_at(self, position, data):
+		'''
+		:param position: byte offset of data in the output
+		:param data: payload bytes
+		'''
+		end = position + len(data)
+		if end > len(self.mapping):
+			self.reserve(max(end, 2 * len(self.mapping), len(self.mapping) + self.grow_size))
+		try:
+			self.mapping[position:end] = data
+		except IndexError:
+			self.mapping[position:end] = bytes(bytearray(data))  # Python 2 only assigns strings into a mapping
+		self.written = max(self.written, end)
+
+	def write(self, data):
+		'''
+		appends data after the furthest write, for streams that arrive in order
+		:param data: payload bytes
+		'''
+		self.write_at(self.written, data)
+
+	def close(self):
+		'''
+		cuts the file back to the bytes actually written and unmaps it
+		'''
+		if self.mapping is None:
+			return
+		self.mapping.close()
+		self.mapping = None
+		self.file.truncate(self.written)
+		self.file.close()
+
+
 class ReliableReceiver(Receiver):
-	#ACK_DATA = bytes(123)#What should our ack be?
-	packet_counter = 0#This will get overwritten by starting_packet_num
-	def __init__(self, starting_packet_num = 0):
+	FIN_ACK_COPIES = 3  # the receiver leaves right after answering a FIN, so the answer goes out several times
+	ACK_EVERY = 4  # in-order frames taken in before an ACK goes out without waiting
+	ACK_DELAY = 0.002  # seconds an ACK for fewer frames may wait for more, well under the sender's 5 ms minimum RTO
+	DELAYED_ACK_COPIES = 2  # no ACK may follow one the delay sent, so it goes out twice in case one copy is lost
+	def __init__(self, starting_packet_num = 0, window_size = 64, checksum_algorithm = checksum.DEFAULT_ALGORITHM, output = None, threaded_output = False, output_path = None, inbound_port = 50005, outbound_port = 50006, simulator = None, timeout = 10, debug_level = logging.WARNING):
 		'''
-		:param starting_packet_num: starting packet number for packet numbers
+		:param starting_packet_num: starting packet number for packet numbers, until the SYN gives the sender's
+		:param window_size: number of frames past packet_counter that are buffered instead of dropped, until the SYN
+			gives the sender's
+		:param checksum_algorithm: checksum algorithm shared with the sender, one of checksum.ALGORITHMS
+		:param output: binary file object the data is written to, stdout by default
+		:param threaded_output: write to output from a separate thread
+		:param output_path: file to write through a memory map instead of output. Each frame is written at its own
+			offset as soon as it arrives, so frames ahead of packet_counter are not held in memory, except in a
+			message stream, whose frames are written in order.
+		:param inbound_port: port data frames arrive on
+		:param outbound_port: port ACKs are sent to
+		:param simulator: channel to receive through, a ChannelSimulator on the two ports by default
+		:param timeout: seconds without any frame before the receiver gives up and returns, for a sender that vanished
+			without closing the transfer. Keep it well above ReliableSender.MAX_RTO, the longest a live sender waits
+			between retransmissions.
+		:param debug_level: lowest level logged. At the default, nothing is logged unless something goes wrong, so
+			no log file is created; logging.INFO adds a line when the transfer starts and one when it ends.
 		'''
-		super(ReliableReceiver, self).__init__()
+		super(ReliableReceiver, self).__init__(inbound_port=inbound_port, outbound_port=outbound_port, timeout=timeout,
+											   debug_level=debug_level, simulator=simulator)
 		
-		ReliableReceiver.packet_counter = starting_packet_num
+		self.packet_counter = starting_packet_num  # next packet number to write out, replaced by the SYN's
+		self.window_size = window_size
+		self.checksum_algorithm = checksum_algorithm
+		self.reorder_buffer = {}  # packet_num -> data for frames that arrived ahead of packet_counter, None once written
+		self.delivered = 0  # frames before packet_counter, which places every frame of the stream in the output
+		self.parity = fec.ParityDecoder(DataGram.PAYLOAD_SIZE)
+		self.loss = fec.LossEstimator()  # reported back in every ACK so the sender can tune its parity ratio
+		self.metrics = metrics.Metrics()
+		self.compressed = False  # set by the SYN of a compressed transfer
+		self.messages = False  # set by the SYN of a message stream, whose short frames must be written in order
+		self.isn = None  # initial sequence number from the SYN, None until a transfer is open
+		self.length = None  # total bytes the SYN announced, None if the sender did not know
+		self.closed = False  # set by the FIN, once every byte is written
+		self.unacked = 0  # frames taken in since the last ACK
+		self.ack_now = False  # set by a frame out of order or a duplicate, which the sender should hear about at once
+		self.ack_deadline = None  # time the pending ACK must go out by, None while no ACK is pending
+		self.expected = None  # packet number after the newest data frame seen or taken as corrupted, from the SYN on
+		self.missing = []  # packet numbers found missing or corrupted in the current batch, for its NAK
+		if output_path is not None:
+			self.writer = MappedWriter(output_path)
+		else:
+			if output is None:
+				output = getattr(sys.stdout, 'buffer', sys.stdout)
+			self.writer = OutputWriter(output, threaded=threaded_output)
 
 	def receive(self):
-		self.logger.info("Receiving on port: {} and replying with ACK on port: {}".format(self.inbound_port, self.outbound_port))
+		self.logger.info("Receiving on port: %s and replying with ACK on port: %s", self.inbound_port, self.outbound_port)
 
+		idle_timeout = self.simulator.rcvr_socket.gettimeout()
 		try:
-			rcvd_flag = 0
-			for i in range(3):
-				#Receives datagram
-				datagram = self.simulator.u_receive()#This bytearray includes [checksum,pack_num,data]
-				
-				#Slices datagram into important sections
-				rcvr_checksum = datagram[0]
-				packet_num = datagram[1]
-				data = datagram[2:]
-				
-				if (packet_num == packet_counter) and Checksum(data, rcvr_checksum) and (rcvd_flag == 0):
-					#We throw out any out of order packets as if they're wrong
-					#The checksum checks if packets are wrong. Those are thrown as well
-					#The sent_flag insures we don't double coutn any packets
-					self.logger.info("Got data from socket: {}".format(data.decode('ascii')))  # note that ASCII will only decode bytes in the range 0-127
-					sys.stdout.write(data)
-					self.simulator.u_send(bytes(packet_num))  # send ACK ->ReliableReceiver.ACK_DATA
-					rcvd_flag = 1
-					ReliableReceiver.packet_counter += 1
-					ReliableReceiver.packet_counter = ReliableReceiver.packet_counter % 256#Ensures that packet_counter loops
+			while not self.closed:
+				#Takes every datagram already waiting, then answers the whole batch at once. While an ACK is held
+				#back, waits only until it is due
+				if self.ack_deadline is None:
+					timeout = idle_timeout
+				else:
+					timeout = max(self.ack_deadline - time.time(), 0.0001)
+				try:
+					replies = self.handle_frames(self.simulator.u_receive_batch(self.window_size, timeout))
+				except socket.timeout:
+					if self.ack_deadline is None:
+						raise
+					replies = []
+				if self.ack_deadline is not None and time.time() >= self.ack_deadline:
+					replies += self.delayed_ack()
+				if replies:
+					self.simulator.u_send_batch(replies)
 		except socket.timeout:
-			pass
-		
-def Checksum(data, rcvr_checksum):
-	'''
-	computes checksum of array and compares it to received checksum
-	:param data: data to compute checksum on
-	:param rcvr_checksum: receieved checksum
-	:return result: boolean 1 for success, 0 for failure
-	'''
-	computed_checksum = 0
-	# Checksum computed by adding byte after byte and modulo 255 to keep it in one byte
-	for i in data:
-		computed_checksum = computed_checksum + i
-		computed_checksum = computed_checksum % 255
-	result = (computed_checksum == rcvr_checksum)
-	return result
-		
-	
+			self.logger.warning("No frame for %s seconds, giving up", idle_timeout)
+		finally:
+			self.writer.close()
+		self.logger.info("Wrote %s bytes, rebuilt %s frames from parity", self.writer.written, self.metrics["recovered"])
+
+	def handle_frames(self, frames):
+		'''
+		checks and takes in a batch of frames received from the channel
+		:param frames: frames received from the channel
+		:return: list of frames to answer with: the answer to any SYN or FIN, an ACK if one is due, and a NAK for
+			frames found missing or corrupted. An ACK for fewer than ACK_EVERY frames in order is held back until
+			ack_deadline, for delayed_ack to send.
+		'''
+		replies = []
+		for frame in frames:
+			self.metrics.count("frames_received")
+			#Checks the datagram. The checksum covers the packet number too, so frames that fail it are thrown out.
+			#Its packet number cannot be trusted, so the frame is taken to be the one expected next
+			datagram = DataGram.from_bytes(frame, self.checksum_algorithm)
+			if datagram is None:
+				self.metrics.count("checksum_failures")
+				if self.expected is not None and not self.closed:
+					self.missing.append(self.expected)
+					self.expected = (self.expected + 1) % header.SEQUENCE_SPACE
+				continue
+
+			if datagram.flags & DataGram.FLAG_ACK:
+				continue
+			if datagram.flags & DataGram.FLAG_SYN:
+				replies += self.accept_syn(datagram)
+				continue
+			if datagram.flags & DataGram.FLAG_FIN:
+				replies += self.accept_fin(datagram)
+				continue
+			if self.isn is None:
+				continue  # nothing is written before the SYN sets where the stream starts
+			if datagram.flags & DataGram.FLAG_PARITY:
+				self.metrics.count("parity_frames_received")
+				recovered = self.parity.add_parity(datagram.packet_num, datagram.data)
+			else:
+				self.skip_to(datagram.packet_num)
+				if not self.accept(datagram.packet_num, datagram.data):
+					continue
+				self.loss.observe(datagram.packet_num)
+				recovered = self.parity.add_data(datagram.packet_num, datagram.data)
+				self.unacked += 1
+
+			#Frames rebuilt from parity count exactly as if they had arrived
+			for packet_num, data in recovered:
+				self.metrics.count("recovered")
+				if self.accept(packet_num, data):
+					self.unacked += 1
+		if self.unacked >= ReliableReceiver.ACK_EVERY or (self.unacked and self.ack_now):
+			replies += self.take_ack()
+		elif self.unacked and self.ack_deadline is None:
+			self.ack_deadline = time.time() + ReliableReceiver.ACK_DELAY
+		if self.missing:
+			replies += self.take_nak()
+		return replies
+
+	def skip_to(self, packet_num):
+		'''
+		notes every frame a data frame skipped over as missing
+		:param packet_num: packet number of a data frame that passed its checksum
+		'''
+		ahead = (packet_num - self.expected) % header.SEQUENCE_SPACE
+		if ahead < self.window_size:
+			self.missing += [(self.expected + k) % header.SEQUENCE_SPACE for k in range(ahead)]
+			self.expected = (packet_num + 1) % header.SEQUENCE_SPACE
+
+	def take_nak(self):
+		'''
+		builds the NAK for the frames found missing or corrupted since the last one, leaving out any that parity
+		rebuilt or that arrived after all
+		:return: list holding the NAK, empty if nothing is still missing
+		'''
+		missing = [packet_num for packet_num in self.missing if packet_num not in self.reorder_buffer
+				   and (packet_num - self.packet_counter) % header.SEQUENCE_SPACE < self.window_size]
+		self.missing = []
+		if not missing:
+			return []
+		self.metrics.count("naks_sent")
+		return [Nak.from_packets(missing, self.checksum_algorithm).to_bytes()]
+
+	def delayed_ack(self):
+		'''
+		sends the ACK that was held back, once ack_deadline has passed
+		:return: list of DELAYED_ACK_COPIES copies of the ACK, empty if none is pending
+		'''
+		if not self.unacked:
+			return []
+		return self.take_ack(ReliableReceiver.DELAYED_ACK_COPIES)
+
+	def take_ack(self, copies = 1):
+		'''
+		builds the ACK for everything taken in so far, which is then no longer pending
+		:param copies: number of copies to send. Every ACK repeats the whole receive state, so any copy that gets
+			through is enough
+		:return: list of ACK frames
+		'''
+		ack = self.make_ack()
+		self.unacked = 0
+		self.ack_now = False
+		self.ack_deadline = None
+		self.metrics.count("acks_sent", copies)
+		return [ack] * copies
+
+	def accept_syn(self, datagram):
+		'''
+		opens the transfer a SYN announces, taking its initial sequence number and options, or answers it again if
+		our SYN-ACK was lost
+		:param datagram: DataGram flagged FLAG_SYN
+		:return: list holding the SYN-ACK, empty for a SYN of another transfer
+		'''
+		if self.isn is None:
+			if len(datagram.data) != header.SYN_PAYLOAD.size:
+				return []
+			length, window_size = header.SYN_PAYLOAD.unpack(bytes(datagram.data))
+			self.isn = self.expected = self.packet_counter = datagram.packet_num
+			self.window_size = window_size
+			if length != header.UNKNOWN_LENGTH:
+				self.length = length
+				if self.writer.random_access:
+					self.writer.reserve(length)
+			if datagram.flags & DataGram.FLAG_MESSAGES:
+				self.messages = True
+			if datagram.flags & DataGram.FLAG_COMPRESSED:
+				self.compressed = True
+				self.writer = compression.DecompressingWriter(self.writer)
+			self.logger.info("Opened transfer at packet %s: %s bytes, window %s, compressed %s", self.isn, self.length,
+							 self.window_size, self.compressed)
+		elif datagram.packet_num != self.isn:
+			return []
+		return [DataGram(b'', self.isn, self.checksum_algorithm, DataGram.FLAG_SYN | DataGram.FLAG_ACK).to_bytes()]
+
+	def accept_fin(self, datagram):
+		'''
+		closes the transfer once every frame before the FIN has been written out
+		:param datagram: DataGram flagged FLAG_FIN, numbered after the last data frame
+		:return: FIN_ACK_COPIES FIN-ACKs, or nothing while frames before the FIN are still missing
+		'''
+		if self.isn is None or datagram.packet_num != self.packet_counter:
+			return []
+		self.closed = True
+		return [DataGram(b'', datagram.packet_num, self.checksum_algorithm, DataGram.FLAG_FIN | DataGram.FLAG_ACK).to_bytes()
+				for _ in range(ReliableReceiver.FIN_ACK_COPIES)]
+
+	def accept(self, packet_num, data):
+		'''
+		buffers a verified data frame and writes out everything that is now in order
+		:param packet_num: packet number of the frame
+		:param data: its payload
+		:return: True if the frame should be acknowledged, False if it is stale
+		'''
+		offset = (packet_num - self.packet_counter) % header.SEQUENCE_SPACE
+		if offset < self.window_size:
+			if packet_num in self.reorder_buffer:
+				self.metrics.count("duplicates")
+				self.ack_now = True
+			elif offset:
+				self.metrics.count("out_of_order")
+				self.ack_now = True
+			#Frames inside the window are held until every frame before them has arrived, unless the writer can put
+			#them in place right away, which takes every frame but the last to be full
+			if self.writer.random_access and not self.messages:
+				if packet_num not in self.reorder_buffer:
+					self.writer.write_at((self.delivered + offset) * DataGram.PAYLOAD_SIZE, data)
+				data = None
+			self.reorder_buffer[packet_num] = data
+			while self.packet_counter in self.reorder_buffer:
+				data = self.reorder_buffer.pop(self.packet_counter)
+				if data is not None:
+					self.writer.write(data)
+				self.delivered += 1
+				self.packet_counter = (self.packet_counter + 1) % header.SEQUENCE_SPACE#Ensures that packet_counter loops
+			return True
+		#Duplicates are ACKed again too, since our earlier ACK for them was lost. Anything else is neither in
+		#the window nor a recent duplicate, so it is a stale frame the channel held back
+		if offset >= header.SEQUENCE_SPACE // 2:
+			self.metrics.count("duplicates")
+			self.ack_now = True
+			return True
+		self.metrics.count("stale")
+		return False
+
+	def metrics_report(self):
+		'''
+		:return: dict of name -> metrics.Metrics for this receiver and its channel, for metrics.dump
+		'''
+		return {"receiver": self.metrics, "channel": self.simulator.metrics}
+
+	def make_ack(self):
+		'''
+		builds a cumulative ACK for packet_counter, with a selective-ack bit for every buffered frame
+		:return: bytearray to send through the channel
+		'''
+		selective = [(packet_num - self.packet_counter) % header.SEQUENCE_SPACE for packet_num in self.reorder_buffer]
+		return Ack(self.packet_counter, selective, self.window_size, self.checksum_algorithm,
+				   self.loss.loss_rate).to_bytes()
+
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Receive reliably over the unreliable channel and write to stdout")
+	parser.add_argument("--asyncio", action="store_true", help="run on the asyncio engine (Python 3 only)")
+	parser.add_argument("--stripes", type=int, default=1, help="receive over this many port pairs in parallel")
+	parser.add_argument("--output", metavar="PATH",
+						help="write to this file, each frame at its own offset through a memory map, instead of stdout")
+	parser.add_argument("--metrics", metavar="PATH",
+						help="write counters and histograms as JSON here at the end, and on SIGUSR1 (single stripe only)")
+	parser.add_argument("--verbose", action="store_true", help="log the start and end of the transfer to ReliableReceiver_<time>.log")
+	args = parser.parse_args()
+
 	# test out BogoReceiver
-	rcvr = ReliableReceiver()
-	rcvr.receive()
+	receiver_class = ReliableReceiver
+	if args.asyncio:
+		try:
+			import aioengine  # Python 3 only
+		except ImportError:
+			sys.exit("--asyncio needs Python 3")
+		receiver_class = aioengine.AsyncReceiver
+	if args.verbose:
+		receiver_class = functools.partial(receiver_class, debug_level=logging.INFO)
+	if args.stripes > 1:
+		import striped
+		with open(args.output, 'wb') if args.output else getattr(sys.stdout, 'buffer', sys.stdout) as stream:
+			striped.receive(stream, args.stripes, receiver_class)
+	else:
+		rcvr = receiver_class(output_path=args.output)
+		if args.metrics:
+			metrics.dump_on_signal(rcvr.metrics_report, args.metrics)
+		rcvr.receive()
+		if args.metrics:
+			metrics.dump(rcvr.metrics_report(), args.metrics)
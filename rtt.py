@@ -0,0 +1,75 @@
+class RttEstimator(object):
+    """
+    Retransmission timeout estimator in the style of RFC 6298: a smoothed RTT and RTT variance are updated from
+    each sample, and the timeout doubles on every expiry until the next sample arrives. Callers apply Karn's rule by
+    only sampling frames that were never retransmitted.
+    """
+
+    # region Constants
+
+    ALPHA = 1.0 / 8  # gain for the smoothed RTT
+    BETA = 1.0 / 4  # gain for the RTT variance
+    K = 4  # number of variances added to the smoothed RTT
+    # endregion Constants
+
+    def __init__(self, initial_rto=1.0, min_rto=0.005, max_rto=10.0, granularity=0.001):
+        """
+        Create an RttEstimator
+        :param initial_rto: timeout used until the first sample, in seconds
+        :param min_rto: lower bound on the timeout, in seconds
+        :param max_rto: upper bound on the timeout, including after backoff, in seconds
+        :param granularity: clock granularity, the smallest variance term added to the smoothed RTT
+        """
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto
+        self.backoff = 1  # multiplier on base_rto, doubled on each expiry
+        self.samples = 0
+
+    @property
+    def rto(self):
+        """
+        Current retransmission timeout, in seconds
+        """
+        return min(self.max_rto, self.base_rto * self.backoff)
+
+    def sample(self, rtt):
+        """
+        Update the estimate with one round trip measurement and clear any backoff
+        :param rtt: measured round trip time, in seconds
+        :return:
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RttEstimator.BETA) * self.rttvar + RttEstimator.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RttEstimator.ALPHA) * self.srtt + RttEstimator.ALPHA * rtt
+        self.base_rto = max(self.min_rto, self.srtt + max(self.granularity, RttEstimator.K * self.rttvar))
+        self.backoff = 1
+        self.samples += 1
+
+    def back_off(self):
+        """
+        Double the timeout after a retransmission timer expired
+        :return:
+        """
+        if self.base_rto * self.backoff < self.max_rto:
+            self.backoff *= 2
+
+    def reset_backoff(self):
+        """
+        Clear the backoff without a sample, as RFC 6298 (5.7) does once a handshake that needed retransmissions
+        completes, so data does not start out on a timeout backed off by SYN losses
+        :return:
+        """
+        self.backoff = 1
+
+    def __repr__(self):
+        if self.srtt is None:
+            return "RttEstimator(rto={:.6f}, no samples)".format(self.rto)
+        return "RttEstimator(rto={:.6f}, srtt={:.6f}, rttvar={:.6f}, samples={})".format(
+            self.rto, self.srtt, self.rttvar, self.samples)
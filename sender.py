@@ -1,21 +1,40 @@
 # Written by S. Mevawala, modified by D. Gitzel
 
+import argparse
+import functools
 import logging
+import mmap
+import os
 import socket
+import stat
+import threading
+import time
 
 import channelsimulator
+import checksum
+import compression
+import congestion
+import fec
+import framepool
+import header
+import messages
+import metrics
+import rtt
 import utils
 import sys
+from header import Ack, DataGram, Nak
 
 class Sender(object):
 
-	def __init__(self, inbound_port=50006, outbound_port=50005, timeout=10, debug_level=logging.INFO):
+	def __init__(self, inbound_port=50006, outbound_port=50005, timeout=10, debug_level=logging.INFO, simulator=None):
 		self.logger = utils.Logger(self.__class__.__name__, debug_level)
 
 		self.inbound_port = inbound_port
 		self.outbound_port = outbound_port
-		self.simulator = channelsimulator.ChannelSimulator(inbound_port=inbound_port, outbound_port=outbound_port,
-														   debug_level=debug_level)
+		if simulator is None:
+			simulator = channelsimulator.ChannelSimulator(inbound_port=inbound_port, outbound_port=outbound_port,
+														  debug_level=debug_level)
+		self.simulator = simulator
 		self.simulator.sndr_setup(timeout)
 		self.simulator.rcvr_setup(timeout)
 
@@ -29,83 +48,631 @@ class BogoSender(Sender):
 		super(BogoSender, self).__init__()
 
 	def send(self, data):
-		self.logger.info("Sending on port: {} and waiting for ACK on port: {}".format(self.outbound_port, self.inbound_port))
+		self.logger.info("Sending on port: %s and waiting for ACK on port: %s", self.outbound_port, self.inbound_port)
 		while True:
 			try:
 				self.simulator.u_send(data)  # send data
 				ack = self.simulator.u_receive()  # receive ACK
-				self.logger.info("Got ACK from socket: {}".format(
-					ack.decode('ascii')))  # note that ASCII will only decode bytes in the range 0-127
+				self.logger.debug("Got ACK from socket: %s", ack)
 				break
 			except socket.timeout:
 				pass
 
+def iter_payloads(source, size):
+	'''
+	re-chunks a stream into payloads, reading only one chunk ahead
+	:param source: file object with a read method, or an iterator of byte chunks of any size
+	:param size: payload size
+	:return: generator of payloads of exactly size bytes, except possibly the last one
+	'''
+	pending = bytearray()
+	for chunk in utils.iter_chunks(source, size):
+		if not pending and len(chunk) == size:
+			yield chunk  # already the right size, pass it through without copying
+			continue
+		pending += chunk
+		while len(pending) >= size:
+			yield bytes(pending[:size])
+			del pending[:size]
+	if pending:
+		yield bytes(pending)
+
+def stream_length(source):
+	'''
+	finds how many bytes a stream still holds, where that can be known up front
+	:param source: file object with a read method, or an iterator of byte chunks of any size
+	:return: bytes left in a regular file, or None for pipes, terminals and iterators
+	'''
+	try:
+		status = os.fstat(source.fileno())
+		if stat.S_ISREG(status.st_mode):
+			return status.st_size - source.tell()
+	except (AttributeError, EnvironmentError, ValueError):
+		pass
+	return None
+
 ############
 class ReliableSender(Sender):
+	SEQUENCE_SPACE = header.SEQUENCE_SPACE
+	MAX_FIN_RETRIES = 3  # every byte is acknowledged before the FIN, so a receiver that stops answering is done
+	MAX_RETRIES = 15  # timeouts in a row of the SYN or of one data frame before the receiver is taken to be gone
+	MAX_RTO = 2.0  # backoff ceiling, well below the receiver's idle timeout so it never gives up between resends
+	KEEPALIVE_INTERVAL = 1.0  # seconds an open message stream may go without a frame before its SYN is sent again
+	SYN_SENT, ESTABLISHED, FIN_SENT, CLOSED, ABORTED = range(5)  # connection phases
 
-	def __init__(self, starting_packet_num = 0, timeout = 1):
+	def __init__(self, starting_packet_num = 0, timeout = 1, window_size = 64, checksum_algorithm = checksum.DEFAULT_ALGORITHM, controller = None, fec_enabled = True, compress = False, inbound_port = 50006, outbound_port = 50005, simulator = None, debug_level = logging.WARNING):
 		'''
 		:param starting_packet_num: starting packet number for packet numbers
-		:param timeout: timeout of sender to trigger resend, may use later
+		:param timeout: initial retransmit timeout in seconds, used until the first RTT sample
+		:param window_size: maximum number of frames outstanding at once
+		:param checksum_algorithm: checksum algorithm shared with the receiver, one of checksum.ALGORITHMS
+		:param controller: congestion.CongestionController that sizes the in-flight window and paces new frames,
+			congestion.AimdController by default
+		:param fec_enabled: send XOR parity frames, at a ratio that follows the loss rate the receiver reports
+		:param compress: zlib compress the stream before framing it, so fewer frames cross the channel
+		:param inbound_port: port ACKs arrive on
+		:param outbound_port: port data frames are sent to
+		:param simulator: channel to send through, a ChannelSimulator on the two ports by default
+		:param debug_level: lowest level logged. At the default, nothing is logged unless something goes wrong, so
+			no log file is created; logging.INFO adds a line when the transfer starts and one when it ends.
 		'''
-		super(ReliableSender, self).__init__()
-		
-		self.timeout = timeout
+		super(ReliableSender, self).__init__(inbound_port=inbound_port, outbound_port=outbound_port, timeout=timeout,
+											 debug_level=debug_level, simulator=simulator)
+
+		# The receiver reports the whole window in one selective-ack bitmap
+		if not 0 < window_size <= Ack.MAX_WINDOW:
+			raise ValueError("window_size must be between 1 and {}".format(Ack.MAX_WINDOW))
+
+		self.rtt = rtt.RttEstimator(initial_rto=timeout, max_rto=ReliableSender.MAX_RTO)  # read rtt.rto and rtt.srtt for diagnostics
+		self.window_size = window_size
+		self.controller = controller if controller is not None else congestion.AimdController(max_window=window_size)
+		self.checksum_algorithm = checksum_algorithm
 		self.packet_num = starting_packet_num
-		self.simulator.sndr_socket.settimeout(timeout)
+		self.fec_enabled = fec_enabled
+		self.flags = DataGram.FLAG_COMPRESSED if compress else 0  # set on every frame so the receiver knows to inflate
+		self.parity = fec.ParityEncoder(DataGram.PAYLOAD_SIZE)
+		# Frames are built in place in recycled buffers, one per outstanding frame plus a few for parity
+		self.pool = framepool.FramePool(channelsimulator.ChannelSimulator.BUFFER_SIZE, window_size + 2)
+		self.metrics = metrics.Metrics()
+		# Held while driving the transfer. The thread driving a message stream waits on it while idle, and
+		# write, flush and close wait on it for the driver's progress
+		self.lock = threading.Condition()
+		self.last_transmit = 0  # time frames were last put on the channel
 
 	def send(self, data):
-		#Create DataGram object
-		datagram = DataGram(data, self.packet_num) 
-		print("checksum="+str(datagram.checksum))
-		print("packetnum="+str(self.packet_num))
-		# Turn it into a bytearray for sending through the channel
-		byte_datagram = bytearray([datagram.checksum, self.packet_num, data]) 
-
-		# Send the data and wait for a good ACK
-		while True: 
+		# Payloads are sliced lazily as views onto data so the input is never copied a second time
+		try:
+			view = memoryview(data)
+		except TypeError:
+			view = data  # a Python 2 mmap has no memoryview, so each of its payloads is sliced off as a copy
+		try:
+			self.send_stream((view[i:i + DataGram.PAYLOAD_SIZE] for i in range(0, len(view), DataGram.PAYLOAD_SIZE)),
+							 len(view))
+		finally:
+			# A transfer that did not finish leaves slices of view in the payload generators. Dropping them and
+			# releasing view lets the caller close a memory map behind data, even while an error passes through.
+			self.payloads = None
+			if hasattr(view, 'release'):
+				view.release()  # Python 3 only
+
+	def send_file(self, path):
+		'''
+		sends a file by framing it straight out of a read-only memory map of it, so the file is never read into memory
+		:param path: file to send
+		'''
+		with open(path, 'rb') as f:
+			if not os.fstat(f.fileno()).st_size:
+				self.send(b'')  # an empty file cannot be mapped
+				return
+			mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 			try:
-				# Send 3 times
-				for i in range(0,3): 
-					self.simulator.u_send(byte_datagram)
-	
-				# Wait for ACK
-				ack = self.simulator.u_recieve()
-
-				if ack == bytes(self.packet_num): # correct ACK ->  break
-					break
-
-				else:
-					send(data) # wrong ACK -> resend
+				self.send(mapping)
+			finally:
+				mapping.close()
+
+	def send_stream(self, source, length = None):
+		'''
+		opens a transfer, sends everything source produces, reading it only as fast as the window opens, and closes
+		the transfer once the receiver has acknowledged every byte
+		:param source: file object with a read method, or an iterator of byte chunks of any size
+		:param length: total bytes source holds, announced to the receiver. Found from source itself if it is a
+			regular file.
+		'''
+		self.logger.info("Sending on port: %s and waiting for ACK on port: %s", self.outbound_port, self.inbound_port)
+
+		self.start(source, length if length is not None else stream_length(source))
+		self.run(lambda: self.done)
+		self.finish()
+
+	def open(self):
+		'''
+		opens a transfer for messages handed over one at a time with write, on the blocking engine. Messages are
+		packed together into full frames, each after its length as messages.encode_length writes it, so many small
+		writes cost few frames; messages.iter_messages splits the received stream up again. Once the handshake is
+		done, a driver thread runs the transfer in the background: a frame that is not full goes out once it has
+		waited messages.FLUSH_DELAY, or on flush or close, and while the application writes nothing the SYN is sent
+		again every KEEPALIVE_INTERVAL so the receiver does not time out.
+		:raises socket.timeout: if the receiver does not answer the SYN
+		'''
+		if self.flags & DataGram.FLAG_COMPRESSED:
+			raise ValueError("A message stream cannot be compressed")
+		self.logger.info("Sending on port: %s and waiting for ACK on port: %s", self.outbound_port, self.inbound_port)
+
+		coalescer = messages.Coalescer(DataGram.PAYLOAD_SIZE)
+		self.start(coalescer.payloads(), framed = True)
+		self.coalescer = coalescer
+		self.run(lambda: self.phase != ReliableSender.SYN_SENT)
+		self.driver = threading.Thread(target=self.drive)
+		self.driver.daemon = True
+		self.driver.start()
+
+	def write(self, message):
+		'''
+		adds a message to the open transfer. Returns at once unless a window's worth of frames is already waiting
+		to go, and then waits for the driver to send some of them.
+		:param message: bytes, bytearray or memoryview
+		:raises socket.timeout: if the receiver stopped answering
+		'''
+		with self.lock:
+			self.check_aborted()
+			self.coalescer.write(message)
+			self.lock.notify_all()
+			while len(self.coalescer.ready) > self.window_size and not self.done:
+				self.lock.wait()
+			self.check_aborted()
+
+	def flush(self):
+		'''
+		sends every message written so far right away and waits until the receiver has acknowledged all of them
+		:raises socket.timeout: if the receiver stopped answering
+		'''
+		with self.lock:
+			self.check_aborted()
+			self.coalescer.flush()
+			self.lock.notify_all()
+			while (self.coalescer.ready or self.base != self.next_index) and not self.done:
+				self.lock.wait()
+			self.check_aborted()
+
+	def close(self):
+		'''
+		sends whatever is still buffered, then closes the transfer opened by open
+		:raises socket.timeout: if the receiver stopped answering
+		'''
+		with self.lock:
+			self.coalescer.close()
+			self.lock.notify_all()
+		self.driver.join()
+		self.check_aborted()
+		self.finish()
+
+	def drive(self):
+		'''
+		(INTERNAL) driver thread of a message stream: runs the transfer until it closes or is aborted. Any error
+		aborts the transfer, and write, flush and close raise it to the application.
+		'''
+		try:
+			self.run(lambda: self.done)
+		except Exception as error:
+			if self.phase != ReliableSender.ABORTED:
+				self.error = error  # abort has already recorded the receiver leaving
+		finally:
+			with self.lock:
+				if not self.done:
+					self.phase = ReliableSender.ABORTED
+				self.lock.notify_all()
+
+	def run(self, finished):
+		'''
+		drives the transfer, filling the window, taking ACKs and retransmitting, until finished returns True
+		:param finished: callable checked each time the window has been filled
+		:raises socket.timeout: if the receiver stopped answering before the transfer closed
+		'''
+		with self.lock:
+			while True:
+				self.check_aborted()
+				pace_delay = self.fill()
+				if finished():
+					return
+				self.lock.notify_all()  # a message stream's writer may be waiting for room or for ACKs
+				if not self.outstanding and self.control is None:
+					self.idle(pace_delay)
+					continue
+
+				# Wait for ACKs, but no longer than the earliest retransmit deadline or the next pacing slot,
+				# then take every ACK already queued. The lock is let go meanwhile, so messages can be written.
+				wait = self.wait_time(pace_delay)
+				self.lock.release()
+				try:
+					acks = self.simulator.u_receive_batch(self.window_size, wait)
+				except socket.timeout:
+					acks = []
+				finally:
+					self.lock.acquire()
+				now = time.time()
+				self.handle_acks(acks, now)
+				self.expire(now)
+
+	def idle(self, pace_delay):
+		'''
+		waits with nothing in flight: for the pacer, or in a message stream for the next write or flush deadline,
+		sending the SYN again if the stream has been quiet for KEEPALIVE_INTERVAL. Called with the lock held.
+		:param pace_delay: seconds until the pacer allows the next frame, 0 if it did not hold anything back
+		'''
+		if self.coalescer is None:
+			time.sleep(pace_delay)
+			return
+		now = time.time()
+		if now - self.last_transmit >= ReliableSender.KEEPALIVE_INTERVAL:
+			self.metrics.count("keepalives")
+			self.transmit([self.syn_frame])  # the receiver answers a copy of the SYN again, which the sender ignores
+		wait = pace_delay or self.last_transmit + ReliableSender.KEEPALIVE_INTERVAL - now
+		if self.coalescer.deadline is not None:
+			wait = min(wait, self.coalescer.deadline - now)
+		if wait > 0:
+			self.lock.wait(wait)
+
+	def start(self, source, length = None, framed = False):
+		'''
+		resets the window for a new stream
+		:param source: file object with a read method, or an iterator of byte chunks of any size
+		:param length: total bytes source holds, or None if unknown
+		:param framed: source is an iterator of payloads of at most PAYLOAD_SIZE bytes, each sent as a frame of its
+			own, where an empty payload means nothing is ready yet
+		'''
+		self.length = length
+		self.phase = ReliableSender.SYN_SENT
+		self.control = None  # Transmission of the SYN or FIN waiting for its answer
+		self.control_seq = None  # sequence number the answer to control carries
+		self.error = None  # exception check_aborted raises once the transfer is aborted
+		self.framed = framed
+		self.coalescer = None  # messages.Coalescer feeding the stream, set by open
+		if framed:
+			self.payloads = iter(source)
+		else:
+			if self.flags & DataGram.FLAG_COMPRESSED:
+				source = compression.compress_stream(source)
+			self.payloads = iter_payloads(source, DataGram.PAYLOAD_SIZE)
+		self.exhausted = False
+		self.base = 0  # index of the oldest unacknowledged payload
+		self.next_index = 0  # index of the next payload to send for the first time
+		self.outstanding = {}  # index -> Transmission
+		self.acked = set()
+
+	@property
+	def done(self):
+		return self.phase in (ReliableSender.CLOSED, ReliableSender.ABORTED)
+
+	def check_aborted(self):
+		'''
+		:raises: the error that aborted the transfer: socket.timeout if expire gave it up, or whatever stopped the
+			driver thread of a message stream
+		'''
+		if self.phase == ReliableSender.ABORTED:
+			raise self.error
+
+	def fill(self):
+		'''
+		fills the window with new frames, pulling payloads from the source only when there is room and the pacer
+		allows another frame
+		:return: seconds until the pacer allows the next frame, 0 if it did not hold anything back
+		'''
+		if self.phase == ReliableSender.SYN_SENT:
+			if self.control is None:
+				length = header.UNKNOWN_LENGTH if self.length is None else self.length
+				# Framed payloads may be short mid-stream, so the receiver must not place frames at fixed offsets
+				flags = DataGram.FLAG_SYN | (DataGram.FLAG_MESSAGES if self.framed else 0)
+				self.send_control(flags, self.packet_num, header.SYN_PAYLOAD.pack(length, self.window_size))
+			return 0
+		if self.phase != ReliableSender.ESTABLISHED:
+			return 0
+		new_frames = []
+		parity_buffers = []
+		pace_delay = 0
+		while not self.exhausted and self.next_index - self.base < self.window_size and len(self.outstanding) < self.controller.window:
+			pace_delay = self.controller.pace(time.time())
+			if pace_delay:
 				break
-			except socket.timeout:
-				pass
+			payload = next(self.payloads, None)
+			if payload is None:
+				self.exhausted = True
+				new_frames += self.make_parity(self.parity.flush(), parity_buffers)  # protect the tail of the stream too
+				break
+			if not len(payload):
+				break  # a message stream with nothing ready yet
+			seq = (self.packet_num + self.next_index) % ReliableSender.SEQUENCE_SPACE
+			buffer = self.pool.acquire()
+			frame = header.pack_into(buffer, seq, payload, self.flags, self.checksum_algorithm)
+			new_frames.append(frame)
+			self.outstanding[self.next_index] = Transmission(frame, time.time(), self.rtt.rto, buffer)
+			self.next_index += 1
+			self.metrics.count("frames_sent")
+			self.metrics.count("bytes_sent", len(payload))
+			if self.fec_enabled:
+				new_frames += self.make_parity(self.parity.add(seq, payload), parity_buffers)
+		if new_frames:
+			self.transmit(new_frames)
+		# The channel has copied everything it keeps, so parity buffers are free as soon as they are sent
+		for buffer in parity_buffers:
+			self.pool.release(buffer)
+		if self.exhausted and self.base == self.next_index:
+			# Every byte is acknowledged, so the transfer can close
+			self.phase = ReliableSender.FIN_SENT
+			self.send_control(DataGram.FLAG_FIN, (self.packet_num + self.next_index) % ReliableSender.SEQUENCE_SPACE)
+		return pace_delay
+
+	def send_control(self, flags, seq, payload = b''):
+		'''
+		sends a SYN or FIN, retransmitted by expire until handle_control takes its answer
+		:param flags: DataGram.FLAG_SYN, with FLAG_MESSAGES for a message stream, or DataGram.FLAG_FIN
+		:param seq: initial sequence number for a SYN, the one after the last data frame for a FIN
+		:param payload: header.SYN_PAYLOAD for a SYN
+		'''
+		frame = DataGram(payload, seq, self.checksum_algorithm, flags | self.flags).to_bytes()
+		self.control_seq = seq
+		self.control = Transmission(frame, time.time(), self.rtt.rto)
+		self.transmit([frame])
+
+	def wait_time(self, pace_delay):
+		'''
+		:param pace_delay: seconds until the pacer allows the next frame, 0 if nothing is waiting on it
+		:return: seconds until the earliest retransmit deadline or pacing slot
+		'''
+		deadlines = [entry.deadline for entry in self.outstanding.values()]
+		if self.control is not None:
+			deadlines.append(self.control.deadline)
+		wait = min(deadlines) - time.time()
+		if pace_delay:
+			wait = min(wait, pace_delay)
+		return max(wait, 0.0001)
+
+	def handle_acks(self, frames, now):
+		'''
+		marks every frame the ACKs cover as delivered, samples the RTT and slides the window
+		:param frames: ACK and NAK frames received from the channel
+		:param now: time they were received
+		'''
+		acked_count = 0
+		naks = []
+		for frame in frames:
+			datagram = DataGram.from_bytes(frame, self.checksum_algorithm)
+			if datagram is not None and datagram.flags & (DataGram.FLAG_SYN | DataGram.FLAG_FIN):
+				self.handle_control(datagram, now)
+				continue
+			if datagram is not None and datagram.flags & DataGram.FLAG_NAK:
+				nak = Nak.from_datagram(datagram)
+				if nak is not None:
+					naks.append(nak)
+				continue
+			ack = Ack.from_datagram(datagram)
+			if ack is None:
+				self.metrics.count("checksum_failures")
+				continue
+			self.metrics.count("acks_received")
+			self.parity.set_loss_rate(ack.loss_rate)
+			# Position of the receiver's next expected frame relative to our window base. ACKs
+			# older than the window come out larger than anything we have sent and are ignored
+			cumulative = (ack.cumulative - self.packet_num - self.base) % ReliableSender.SEQUENCE_SPACE
+			if cumulative > self.next_index - self.base:
+				self.metrics.count("stale_acks")
+			else:
+				newly_acked = list(range(self.base, self.base + cumulative))
+				newly_acked += [self.base + cumulative + offset for offset in ack.selective]
+				newest = None
+				for index in newly_acked:
+					if index in self.outstanding:
+						entry = self.outstanding.pop(index)
+						self.pool.release(entry.buffer)
+						self.acked.add(index)
+						acked_count += 1
+						if not entry.retransmitted and (newest is None or entry.sent_at > newest.sent_at):
+							newest = entry
+				# Karn's rule: only frames sent exactly once give an unambiguous RTT sample
+				if newest is not None:
+					self.rtt.sample(now - newest.sent_at)
+					self.metrics.histogram("rtt", unit=1e-6).add(now - newest.sent_at)
+					# Frames sent before the estimate dropped should not keep waiting on the old timeout
+					for entry in self.outstanding.values():
+						entry.deadline = min(entry.deadline, entry.last_sent + self.rtt.rto)
+		if acked_count:
+			self.controller.on_ack(acked_count, now, self.rtt.srtt)
+
+		# Slide the window past every acknowledged frame
+		while self.base in self.acked:
+			self.acked.remove(self.base)
+			self.base += 1
+		# NAKs are taken after the ACKs of the same batch, so frames those cover are not sent again
+		for nak in naks:
+			self.handle_nak(nak, now)
+
+	def handle_nak(self, nak, now):
+		'''
+		resends the frames a NAK reports missing or corrupted right away instead of waiting for their timers, unless
+		they were already sent again within the last round trip
+		:param nak: Nak from the receiver
+		:param now: time it was received
+		'''
+		self.metrics.count("naks_received")
+		resent = []
+		for packet_num, count in nak.ranges:
+			first = self.base + (packet_num - self.packet_num - self.base) % ReliableSender.SEQUENCE_SPACE
+			for index in range(first, min(first + count, self.next_index)):
+				entry = self.outstanding.get(index)
+				if entry is None or (self.rtt.srtt is not None and now - entry.last_sent < self.rtt.srtt):
+					continue
+				entry.resend(now, self.rtt.rto)
+				resent.append(entry)
+		if resent:
+			self.controller.on_loss(len(resent), now, self.rtt.srtt)
+			self.metrics.count("fast_retransmits", len(resent))
+			self.metrics.count("retransmits", len(resent))
+			self.transmit(entry.frame for entry in resent)
+
+	def handle_control(self, datagram, now):
+		'''
+		takes the receiver's SYN-ACK or FIN-ACK, moving the transfer on to its next phase
+		:param datagram: DataGram flagged FLAG_SYN or FLAG_FIN
+		:param now: time it was received
+		'''
+		expected = {ReliableSender.SYN_SENT: DataGram.FLAG_SYN, ReliableSender.FIN_SENT: DataGram.FLAG_FIN}.get(self.phase)
+		if expected is None or not datagram.flags & expected or not datagram.flags & DataGram.FLAG_ACK \
+				or datagram.packet_num != self.control_seq:
+			return  # a late copy of an answer already taken
+		if not self.control.retransmitted:
+			self.rtt.sample(now - self.control.sent_at)  # the SYN gives the first RTT sample before any data is sent
+		else:
+			self.rtt.reset_backoff()
+		if self.phase == ReliableSender.SYN_SENT:
+			self.syn_frame = self.control.frame  # sent again by idle to keep the receiver waiting
+		self.control = None
+		self.phase = ReliableSender.ESTABLISHED if self.phase == ReliableSender.SYN_SENT else ReliableSender.CLOSED
 
-class DataGram(object):
-	def __init__(self, data, packetNum):
+	def expire(self, now):
 		'''
-		:param data: data inside the packet
-		:param packetNUM: number of the packet being sent
+		resends only the frames whose timer has run out, backing the timeout off once per expiry
+		:param now: current time
 		'''
-		self.data = data
-		self.packet_num = packetNum
-		self.checksum = self.Checksum(data)
+		if self.control is not None and self.control.deadline <= now:
+			if self.phase == ReliableSender.FIN_SENT:
+				# No backoff: a missing FIN-ACK more likely means the receiver has left than that the path is congested
+				if self.control.timeouts >= ReliableSender.MAX_FIN_RETRIES:
+					self.logger.warning("No FIN-ACK after %s retries, closing", ReliableSender.MAX_FIN_RETRIES)
+					self.control = None
+					self.phase = ReliableSender.CLOSED
+					return
+			elif self.control.timeouts >= ReliableSender.MAX_RETRIES:
+				self.abort()
+				return
+			else:
+				self.rtt.back_off()
+			self.metrics.count("control_retransmits")
+			self.control.timeouts += 1
+			self.control.resend(now, self.rtt.rto)
+			self.transmit([self.control.frame])
+		expired = [entry for entry in self.outstanding.values() if entry.deadline <= now]
+		if expired:
+			if any(entry.timeouts >= ReliableSender.MAX_RETRIES for entry in expired):
+				self.abort()
+				return
+			self.rtt.back_off()
+			self.controller.on_loss(len(expired), now, self.rtt.srtt)
+			self.metrics.count("timeouts")
+			self.metrics.count("retransmits", len(expired))
+			for entry in expired:
+				entry.timeouts += 1
+				entry.resend(now, self.rtt.rto)
+			self.transmit(entry.frame for entry in expired)
 
-	def Checksum(self, data):
+	def abort(self):
 		'''
-		computes checksum of the array
-		:param data: data to compute checksum on
-		:return result: value of checksum
+		gives the transfer up once the receiver has stopped answering, freeing every outstanding frame
 		'''
-		result = 0
-		# Checksum computed by adding byte after byte and modulo 255 to keep it in one byte
-		for i in data:
-			result = result + i
-			result = result % 255
-		return result
-	
+		self.logger.warning("No ACK after %s retries, %s frames unacknowledged, aborting",
+			ReliableSender.MAX_RETRIES, self.next_index - self.base)
+		for entry in self.outstanding.values():
+			self.pool.release(entry.buffer)
+		self.outstanding = {}
+		self.control = None
+		self.error = socket.timeout("No ACK after {} retries, transfer aborted".format(ReliableSender.MAX_RETRIES))
+		self.phase = ReliableSender.ABORTED
+
+	def finish(self):
+		'''
+		logs the transfer and moves the packet numbers past it, so the next stream continues from there
+		'''
+		self.logger.info("Sent %s frames and %s retransmissions, %s, congestion window %s, %s",
+			self.next_index, self.metrics["retransmits"], self.rtt, self.controller.window, self.pool)
+		self.packet_num = (self.packet_num + self.next_index) % ReliableSender.SEQUENCE_SPACE
+
+	def metrics_report(self):
+		'''
+		:return: dict of name -> metrics.Metrics for this sender and its channel, for metrics.dump
+		'''
+		return {"sender": self.metrics, "channel": self.simulator.metrics}
+
+	def transmit(self, frames):
+		'''
+		puts frames on the channel
+		:param frames: iterable of frames
+		'''
+		self.simulator.u_send_batch(frames)
+		self.last_transmit = time.time()
+
+	def make_parity(self, group, buffers):
+		'''
+		builds the parity frame for a finished fec group in a pooled buffer
+		:param group: (first packet number, parity payload) from the ParityEncoder, or None
+		:param buffers: list the buffer is appended to, for the caller to release once the frame is sent
+		:return: list holding the parity frame, empty if there is no group
+		'''
+		if group is None:
+			return []
+		first, parity = group
+		buffers.append(self.pool.acquire())
+		self.metrics.count("parity_frames_sent")
+		return [header.pack_into(buffers[-1], first, parity, DataGram.FLAG_PARITY | self.flags, self.checksum_algorithm)]
+
+
+class Transmission(object):
+	__slots__ = ('frame', 'buffer', 'sent_at', 'last_sent', 'deadline', 'retransmitted', 'timeouts')
+
+	def __init__(self, frame, sent_at, rto, buffer = None):
+		'''
+		retransmit timer state for one outstanding frame
+		:param frame: bytes put on the channel
+		:param sent_at: time of the first transmission
+		:param rto: retransmission timeout in effect when it was sent
+		:param buffer: pooled buffer holding the frame, released once the frame is acknowledged
+		'''
+		self.frame = frame
+		self.buffer = buffer
+		self.sent_at = sent_at
+		self.last_sent = sent_at
+		self.deadline = sent_at + rto
+		self.retransmitted = False
+		self.timeouts = 0  # expiries of its timer, counted by ReliableSender.expire
+
+	def resend(self, now, rto):
+		self.last_sent = now
+		self.deadline = now + rto
+		self.retransmitted = True
+
+
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Send stdin reliably over the unreliable channel")
+	parser.add_argument("--asyncio", action="store_true", help="run on the asyncio engine (Python 3 only)")
+	parser.add_argument("--stripes", type=int, default=1, help="send over this many port pairs in parallel")
+	parser.add_argument("--input", metavar="PATH", help="send this file, framed out of a memory map of it, instead of stdin")
+	parser.add_argument("--compress", action="store_true", help="zlib compress the stream before framing it")
+	parser.add_argument("--metrics", metavar="PATH",
+						help="write counters and histograms as JSON here at the end, and on SIGUSR1 (single stripe only)")
+	parser.add_argument("--verbose", action="store_true", help="log the start and end of the transfer to ReliableSender_<time>.log")
+	args = parser.parse_args()
+
 	# test out BogoSender
-	DATA = bytearray(sys.stdin.read())
-	sndr = ReliableSender()
-	sndr.send(DATA)
+	sender_class = ReliableSender
+	if args.asyncio:
+		try:
+			import aioengine  # Python 3 only
+		except ImportError:
+			sys.exit("--asyncio needs Python 3")
+		sender_class = aioengine.AsyncSender
+	if args.compress:
+		sender_class = functools.partial(sender_class, compress=True)
+	if args.verbose:
+		sender_class = functools.partial(sender_class, debug_level=logging.INFO)
+	source = getattr(sys.stdin, 'buffer', sys.stdin)  # stream stdin instead of reading it all first
+	if args.stripes > 1:
+		import striped
+		with open(args.input, 'rb') if args.input else source as stream:
+			striped.send(stream, args.stripes, sender_class)
+	else:
+		sndr = sender_class()
+		if args.metrics:
+			metrics.dump_on_signal(sndr.metrics_report, args.metrics)
+		if args.input:
+			sndr.send_file(args.input)
+		else:
+			sndr.send_stream(source)
+		if args.metrics:
+			metrics.dump(sndr.metrics_report(), args.metrics)
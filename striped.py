@@ -0,0 +1,178 @@
+"""
+Striped transfers: the input is cut into SEGMENT_SIZE segments dealt round robin over several stripes. Each stripe
+is an ordinary reliable transfer on its own port pair, run by its own worker process so the stripes use separate
+cores. Segment k travels on stripe k % stripes; every segment but the last is full, so the receiver can put the
+stream back together by taking SEGMENT_SIZE bytes from each stripe in turn.
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+import utils
+from receiver import ReliableReceiver
+from sender import ReliableSender, iter_payloads
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+# region Constants
+
+SEGMENT_SIZE = 256 * 1024
+DATA_PORT = 50005  # stripe i carries data to DATA_PORT + 2 * i and ACKs to DATA_PORT + 2 * i + 1
+QUEUED_SEGMENTS = 4  # segments waiting for each sending worker before the reader blocks
+PUT_TIMEOUT = 0.5  # seconds between checks that a sending worker is still alive while its queue is full
+# endregion Constants
+
+# region Helper Functions
+
+
+def stripe_ports(stripe):
+    """
+    Port pair of one stripe
+    :param stripe: stripe index
+    :return: (data port, ACK port)
+    """
+    return DATA_PORT + 2 * stripe, DATA_PORT + 2 * stripe + 1
+
+
+def interleave(streams, output, segment_size=SEGMENT_SIZE):
+    """
+    Rebuild the original stream from the stripes
+    :param streams: binary file objects holding each stripe's data, in stripe order
+    :param output: binary file object to write the stream to
+    :param segment_size: segment size the sender dealt the stream out in
+    :return: number of bytes written
+    """
+    written = 0
+    while True:
+        for stream in streams:
+            segment = stream.read(segment_size)
+            output.write(segment)
+            written += len(segment)
+            if len(segment) < segment_size:
+                # only the final segment is short, and nothing follows it on any stripe
+                output.flush()
+                return written
+
+
+def feed(queue, worker, segment):
+    """
+    (INTERNAL) Queue a segment for a sending worker, waiting for room only as long as the worker is alive
+    :param queue: the worker's multiprocessing.Queue
+    :param worker: multiprocessing.Process reading it
+    :param segment: bytes, or None to end the stripe
+    :return: True if the segment was queued, False if the worker has exited
+    """
+    while worker.is_alive():
+        try:
+            queue.put(segment, timeout=PUT_TIMEOUT)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def check_workers(workers):
+    """
+    (INTERNAL) Raise if any joined worker failed
+    :param workers: joined multiprocessing.Process per stripe, in stripe order
+    :return:
+    """
+    failed = ["stripe {} (exit code {})".format(stripe, worker.exitcode)
+              for stripe, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError("Striped transfer failed: " + ", ".join(failed))
+
+
+def send_stripe(stripe, segments, sender_class):
+    """
+    (INTERNAL) Worker process: send the segments queued for one stripe
+    :param stripe: stripe index
+    :param segments: multiprocessing.Queue of segments, ended by None
+    :param sender_class: ReliableSender or a subclass
+    :return:
+    """
+    data_port, ack_port = stripe_ports(stripe)
+    sender = sender_class(inbound_port=ack_port, outbound_port=data_port)
+    sender.send_stream(iter(segments.get, None))
+    utils.flush()  # the worker leaves through os._exit, which skips the flush at exit
+
+
+def receive_stripe(stripe, path, receiver_class):
+    """
+    (INTERNAL) Worker process: receive one stripe into a file
+    :param stripe: stripe index
+    :param path: file the stripe's data is written to
+    :param receiver_class: ReliableReceiver or a subclass
+    :return:
+    """
+    data_port, ack_port = stripe_ports(stripe)
+    with open(path, "wb") as output:
+        receiver = receiver_class(output=output, inbound_port=data_port, outbound_port=ack_port)
+        receiver.receive()
+    utils.flush()
+    if not receiver.closed:
+        # the receiver gave up waiting, so the stripe is short and must not be interleaved
+        sys.exit("Stripe {} ended before its transfer closed".format(stripe))
+# endregion Helper Functions
+
+
+def send(source, stripes, sender_class=ReliableSender):
+    """
+    Send a stream over several stripes at once
+    :param source: file object with a read method, or an iterator of byte chunks of any size
+    :param stripes: number of stripes
+    :param sender_class: ReliableSender or a subclass, run in every worker
+    :return:
+    :raises RuntimeError: if any stripe's worker failed, e.g. because its receiver stopped answering
+    """
+    queues = [multiprocessing.Queue(QUEUED_SEGMENTS) for _ in range(stripes)]
+    workers = [multiprocessing.Process(target=send_stripe, args=(stripe, queues[stripe], sender_class))
+               for stripe in range(stripes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for index, segment in enumerate(iter_payloads(source, SEGMENT_SIZE)):
+            if not feed(queues[index % stripes], workers[index % stripes], segment):
+                break  # a stripe is lost, so the rest of the stream cannot be put back together anyway
+    finally:
+        for queue, worker in zip(queues, workers):
+            if not feed(queue, worker, None):
+                queue.cancel_join_thread()  # nobody will read what is left in it, so do not wait to flush it
+        for worker in workers:
+            worker.join()
+    check_workers(workers)
+
+
+def receive(output, stripes, receiver_class=ReliableReceiver):
+    """
+    Receive a stream sent over several stripes. Receiving workers must not block on a slow output while the others
+    wait for their turn, so each stripe goes to a temporary file and is interleaved once every stripe is complete.
+    :param output: binary file object to write the stream to
+    :param stripes: number of stripes
+    :param receiver_class: ReliableReceiver or a subclass, run in every worker
+    :return: number of bytes written
+    :raises RuntimeError: if any stripe's worker failed or gave up before its transfer closed
+    """
+    directory = tempfile.mkdtemp(prefix="stripes")
+    try:
+        paths = [os.path.join(directory, str(stripe)) for stripe in range(stripes)]
+        workers = [multiprocessing.Process(target=receive_stripe, args=(stripe, paths[stripe], receiver_class))
+                   for stripe in range(stripes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        check_workers(workers)
+        streams = [open(path, "rb") for path in paths]
+        try:
+            return interleave(streams, output)
+        finally:
+            for stream in streams:
+                stream.close()
+    finally:
+        shutil.rmtree(directory)
@@ -1,8 +1,74 @@
+import base64
+import io
 import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from copy import deepcopy
 
+import checksum
+import compression
+import header
+import intcodec
+import messages
+import striped
+import utils
+from benchmark import file_digest, generate_input
+from congestion import AimdController, CongestionController, TokenBucketPacer
+from fec import LossEstimator, ParityDecoder, ParityEncoder, group_size_for
+from framepool import FramePool
+from header import Ack, DataGram, Nak
+from loopback import ChannelTrace, LoopbackChannel, LoopbackNetwork
+from metrics import Histogram, Metrics
 from channelsimulator import ChannelSimulator, slice_frames
+from receiver import MappedWriter, OutputWriter, ReliableReceiver
+from rtt import RttEstimator
+from sender import ReliableSender, iter_payloads, stream_length
+from striped import interleave, stripe_ports
+
+try:
+    import aioengine
+except ImportError:
+    aioengine = None  # Python 2
+
+
+def setUpModule():
+    # the channel tests log at DEBUG, so keep their files out of the working directory
+    utils.LOG_DIRECTORY = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    utils.flush()
+    shutil.rmtree(utils.LOG_DIRECTORY, ignore_errors=True)
+    utils.LOG_DIRECTORY = os.curdir
+
+
+def loopback_transfer(send, output=None, output_path=None, timeout=10, **sender_args):
+    """
+    Run a ReliableReceiver in a thread and a ReliableSender in this one, over seeded channels on their own network
+    :param send: called with the sender to run the transfer, e.g. lambda sender: sender.send(data)
+    :param output: binary file object the receiver writes to
+    :param output_path: file the receiver writes through a memory map instead
+    :param timeout: seconds the receiver waits for a frame before giving up
+    :param sender_args: further ReliableSender arguments
+    :return: (sender, receiver) once the receiver has returned
+    """
+    network = LoopbackNetwork()
+    receiver = ReliableReceiver(output=output, output_path=output_path, timeout=timeout,
+                                simulator=LoopbackChannel(50005, 50006, seed=1, network=network))
+    thread = threading.Thread(target=receiver.receive)
+    thread.start()
+    try:
+        sender = ReliableSender(simulator=LoopbackChannel(50006, 50005, seed=2, network=network), **sender_args)
+        send(sender)
+    finally:
+        thread.join()
+    return sender, receiver
 
 
 class TestChannelSimulator(unittest.TestCase):
@@ -16,11 +82,15 @@ class TestChannelSimulator(unittest.TestCase):
 
     def test_slice_frames(self):
         c = self.setup_channel()
-        frames = slice_frames(self.get_test_bytes(4 * ChannelSimulator.BUFFER_SIZE + 1))
+        test_data = self.get_test_bytes(4 * ChannelSimulator.BUFFER_SIZE + 1)
+        frames = list(slice_frames(test_data))
         assert len(frames) == 5
         for f in frames[:-2]:
             assert len(f) == ChannelSimulator.BUFFER_SIZE
         assert len(frames[-1]) == 1
+        # frames are views onto the input, not copies
+        test_data[0] = 66
+        assert frames[0][0] in (66, b"B")
 
     def test_corrupt_none(self):
         c = self.setup_channel()
@@ -48,6 +118,807 @@ class TestChannelSimulator(unittest.TestCase):
         corrupted_bytes = c.corrupt(test_data, drop_error_prob=0, swap_error_prob=0, random_error_prob=1)
         assert test_data != corrupted_bytes
 
+    def test_batch_round_trip(self):
+        c = ChannelSimulator(inbound_port=44445, outbound_port=44445)
+        c.sndr_setup(1)
+        c.rcvr_setup(1)
+        c.corrupt = lambda frame: frame
+        try:
+            frames = [self.get_test_bytes(n) for n in (1, 10, ChannelSimulator.BUFFER_SIZE)]
+            c.u_send_batch(frames)
+            received = []
+            while len(received) < len(frames):
+                received += c.u_receive_batch(max_frames=16, timeout=1)
+            assert received == frames
+            with self.assertRaises(socket.timeout):
+                c.u_receive_batch(timeout=0.01)
+            assert c.rcvr_socket.gettimeout() == 1  # the wait applies to that call only
+        finally:
+            c.sndr_socket.close()
+            c.rcvr_socket.close()
+
+    def test_corruption_mask(self):
+        c = self.setup_channel()
+        mask = c.corruption_mask(4 * ChannelSimulator.BUFFER_SIZE)
+        assert len(mask) == 4 * ChannelSimulator.BUFFER_SIZE
+        assert set(mask) == set(ChannelSimulator.CORRUPTERS)
+
+    def test_drop_rate(self):
+        c = self.setup_channel()
+        test_data = self.get_test_bytes(16)
+        drops = sum(c.corrupt(test_data, drop_error_prob=0.1, swap_error_prob=0, random_error_prob=0) is None
+                    for _ in range(20000))
+        # 20000 frames at 10% is 2000 drops with a standard deviation of about 42
+        assert 1750 < drops < 2250
+
+
+class TestDataGram(unittest.TestCase):
+    def test_round_trip(self):
+        payload = bytearray([65] * DataGram.PAYLOAD_SIZE)
+        frame = DataGram(payload, 7).to_bytes()
+        assert len(frame) <= ChannelSimulator.BUFFER_SIZE
+        datagram = DataGram.from_bytes(frame)
+        assert datagram.packet_num == 7
+        assert datagram.data == payload
+
+    def test_parity_frame_fits(self):
+        encoder = ParityEncoder(DataGram.PAYLOAD_SIZE, group_size=1)
+        first, parity = encoder.add(7, bytearray([65] * DataGram.PAYLOAD_SIZE))
+        frame = DataGram(parity, first, flags=DataGram.FLAG_PARITY).to_bytes()
+        assert len(frame) == ChannelSimulator.BUFFER_SIZE
+        assert DataGram.from_bytes(frame).flags == DataGram.FLAG_PARITY
+
+    def test_corrupt_frame_rejected(self):
+        frame = DataGram(bytearray([65] * 10), 7).to_bytes()
+        frame[1] ^= 1
+        assert DataGram.from_bytes(frame) is None
+
+
+class TestHeader(unittest.TestCase):
+    def test_round_trip(self):
+        frame = header.encode(2 ** 32 + 5, b"hello", header.FLAG_PARITY)
+        assert len(frame) == header.HEADER_SIZE + 5
+        assert header.decode(frame) == (5, header.FLAG_PARITY, b"hello")
+
+    def test_wrong_version_rejected(self):
+        frame = header.encode(5, b"hello")
+        frame[header.CHECKSUM_SIZE] += 1
+        assert header.decode(frame) is None
+
+    def test_truncated_frame_rejected(self):
+        frame = header.encode(5, b"hello")
+        assert header.decode(frame[:-1]) is None
+        assert header.decode(frame[:header.HEADER_SIZE - 1]) is None
+
+    def test_pack_into_reused_buffer(self):
+        buffer = bytearray(b"x" * 64)
+        frame = header.pack_into(buffer, 9, b"abc", header.FLAG_PARITY)
+        assert len(frame) == header.HEADER_SIZE + 3
+        assert header.decode(bytearray(frame)) == (9, header.FLAG_PARITY, b"abc")
+        assert bytearray(frame) == header.encode(9, b"abc", header.FLAG_PARITY)
+
+    def test_data_frame_is_not_an_ack(self):
+        assert Ack.from_bytes(DataGram(bytearray(9), 7).to_bytes()) is None
+
+
+class TestFramePool(unittest.TestCase):
+    def test_reuses_released_buffers(self):
+        pool = FramePool(16, capacity=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        pool.release(first)
+        assert pool.acquire() is first
+        assert pool.allocations == 0
+        assert pool.acquire() is not second
+        assert pool.allocations == 1
+        assert pool.acquired == 4
+        assert pool.allocations_per_frame == 0.25
+
+
+class TestIterPayloads(unittest.TestCase):
+    def test_rechunks_iterator(self):
+        payloads = list(iter_payloads(iter([b"abc", b"", b"defgh", b"i"]), 4))
+        assert payloads == [b"abcd", b"efgh", b"i"]
+
+    def test_reads_file(self):
+        source = io.BytesIO(b"abcdefghij")
+        assert list(iter_payloads(source, 4)) == [b"abcd", b"efgh", b"ij"]
+
+    def test_iter_chunks(self):
+        assert list(utils.iter_chunks(io.BytesIO(b"abcdefghij"), 4)) == [b"abcd", b"efgh", b"ij"]
+        chunks = iter([b"abc", b"defgh"])
+        assert utils.iter_chunks(chunks, 4) is chunks
+
+
+class TestAck(unittest.TestCase):
+    def test_round_trip(self):
+        ack = Ack.from_bytes(Ack(2 ** 32 - 6, [1, 5, 63], loss_rate=0.015).to_bytes())
+        assert ack.cumulative == 2 ** 32 - 6
+        assert ack.selective == [1, 5, 63]
+        assert ack.loss_rate == 0.015
+
+
+class TestIntCodec(unittest.TestCase):
+    def test_byte_order(self):
+        assert intcodec.bytes_to_int(bytearray(b"\x01\x02")) == 0x0102
+        assert intcodec.bytes_to_int(memoryview(b"\x01\x02"), "little") == 0x0201
+        assert intcodec.bytes_to_int(b"") == 0
+        assert intcodec.int_to_bytes(0x0102, 3) == bytearray(b"\x00\x01\x02")
+
+
+class TestChecksum(unittest.TestCase):
+    @staticmethod
+    def reference_fletcher32(data):
+        data = bytearray(data) + bytearray(len(data) % 2)
+        sum1 = sum2 = 0
+        for i in range(0, len(data), 2):
+            sum1 = (sum1 + data[i] + 256 * data[i + 1]) % 65535
+            sum2 = (sum2 + sum1) % 65535
+        return (sum2 << 16) | sum1
+
+    def test_fletcher32(self):
+        for n in (0, 1, 2, 3, 1023, 1024):
+            data = bytearray((7 * i + 3) % 256 for i in range(n))
+            assert checksum.fletcher32(data) == self.reference_fletcher32(data)
+        assert checksum.fletcher32(bytearray([255] * 1024)) == self.reference_fletcher32(bytearray([255] * 1024))
+
+    def test_offset(self):
+        data = bytearray(b"headerpayload")
+        for name in checksum.ALGORITHMS:
+            assert checksum.compute(data, name, 6) == checksum.compute(bytearray(b"payload"), name)
+
+    def test_detects_swapped_bytes(self):
+        for name in checksum.ALGORITHMS:
+            assert checksum.compute(bytearray(b"ab"), name) != checksum.compute(bytearray(b"ba"), name)
+
+    def test_end(self):
+        data = bytearray(b"0123456789")
+        for name in checksum.ALGORITHMS:
+            assert checksum.compute(data, name, 2, 7) == checksum.compute(data[2:7], name)
+            assert checksum.compute(memoryview(data), name, 2, 7) == checksum.compute(data[2:7], name)
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, checksum.compute, bytearray(b"a"), "md5")
+
+
+class TestRttEstimator(unittest.TestCase):
+    def test_first_sample(self):
+        estimator = RttEstimator(initial_rto=1.0, min_rto=0)
+        estimator.sample(0.1)
+        assert estimator.srtt == 0.1
+        assert abs(estimator.rto - 0.3) < 1e-9  # srtt + 4 * rtt / 2
+
+    def test_backoff(self):
+        estimator = RttEstimator(initial_rto=1.0, max_rto=3.0)
+        estimator.back_off()
+        assert estimator.rto == 2.0
+        estimator.back_off()
+        assert estimator.rto == 3.0
+        estimator.sample(0.1)
+        assert estimator.rto < 1.0
+
+
+class TestCongestion(unittest.TestCase):
+    def test_slow_start_and_cap(self):
+        controller = AimdController(max_window=64, initial_window=4)
+        controller.on_ack(4, 0, 0.01)
+        assert controller.window == 8
+        controller.on_ack(1000, 0, 0.01)
+        assert controller.window == 64
+
+    def test_random_loss_tolerated(self):
+        controller = AimdController(max_window=64, initial_window=64)
+        controller.on_ack(200, 0, 0.01)
+        controller.on_loss(1, 1, 0.01)
+        assert controller.window == 64
+
+    def test_heavy_loss_halves_window(self):
+        controller = AimdController(max_window=64, initial_window=64)
+        controller.on_loss(32, 1, 0.01)
+        assert controller.window == 32
+        controller.on_loss(32, 1.001, 0.01)  # within one RTT of the last cut
+        assert controller.window == 32
+
+    def test_pacer(self):
+        pacer = TokenBucketPacer(rate=100, burst=2)
+        assert pacer.delay(0) == 0
+        assert pacer.delay(0) == 0
+        assert abs(pacer.delay(0) - 0.01) < 1e-9
+        assert pacer.delay(0.01) == 0
+
+
+class TestFec(unittest.TestCase):
+    def test_recovers_missing_frame(self):
+        payloads = [bytearray([65 + i] * 16) for i in range(3)] + [bytearray(b"tail")]
+        encoder = ParityEncoder(16, group_size=4)
+        groups = [encoder.add(250 + i, payload) for i, payload in enumerate(payloads)]
+        assert groups[:3] == [None, None, None]
+        first, parity = groups[3]
+        for lost in range(4):
+            decoder = ParityDecoder(16)
+            for i, payload in enumerate(payloads):
+                if i != lost:
+                    assert decoder.add_data((250 + i) % 256, payload) == []
+            assert decoder.add_parity(first, parity) == [((250 + lost) % 256, payloads[lost])]
+
+    def test_two_losses_not_recovered(self):
+        encoder = ParityEncoder(4, group_size=3)
+        for i in range(2):
+            encoder.add(i, bytearray(b"abcd"))
+        first, parity = encoder.add(2, bytearray(b"efgh"))
+        decoder = ParityDecoder(4)
+        decoder.add_data(0, bytearray(b"abcd"))
+        assert decoder.add_parity(first, parity) == []
+
+    def test_group_size_follows_loss(self):
+        assert group_size_for(0) is None
+        assert group_size_for(0.015) == 16
+        assert group_size_for(0.5) == 2
+
+    def test_loss_estimator(self):
+        estimator = LossEstimator(gain=0.5)
+        estimator.observe(0)
+        estimator.observe(1)
+        assert estimator.loss_rate == 0
+        estimator.observe(3)
+        assert 0 < estimator.loss_rate < 1
+
+
+class TestOutputWriter(unittest.TestCase):
+    def check_writer(self, threaded):
+        stream = io.BytesIO()
+        writer = OutputWriter(stream, buffer_size=8, threaded=threaded)
+        for chunk in (b"abc", b"defgh", b"ij"):
+            writer.write(bytearray(chunk))
+        writer.close()
+        assert stream.getvalue() == b"abcdefghij"
+        assert writer.written == 10
+
+    def test_buffered(self):
+        self.check_writer(threaded=False)
+
+    def test_threaded(self):
+        self.check_writer(threaded=True)
+
+
+class TestMappedWriter(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_out_of_order_and_growth(self):
+        writer = MappedWriter(self.path, grow_size=4)
+        writer.write_at(8, bytearray(b"ij"))
+        writer.write_at(0, bytearray(b"abcd"))
+        writer.write_at(4, memoryview(bytearray(b"efgh")))
+        writer.close()
+        with open(self.path, "rb") as f:
+            assert f.read() == b"abcdefghij"
+        assert writer.written == 10
+
+    def test_reserve_keeps_data(self):
+        writer = MappedWriter(self.path, grow_size=4)
+        writer.write(bytearray(b"abcd"))
+        writer.reserve(1 << 20)
+        assert len(writer.mapping) == 1 << 20
+        writer.write(bytearray(b"ef"))
+        writer.close()
+        with open(self.path, "rb") as f:
+            assert f.read() == b"abcdef"
+
+    def test_file_transfer(self):
+        data = bytes(bytearray(i % 251 for i in range(50000)))
+        with open(self.path, "wb") as f:
+            f.write(data)
+        handle, output_path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            sender, receiver = loopback_transfer(lambda sender: sender.send_file(self.path), output_path=output_path)
+            with open(output_path, "rb") as f:
+                assert f.read() == data
+            assert not receiver.reorder_buffer
+        finally:
+            os.remove(output_path)
+
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        data = base64.b64encode(bytes(bytearray(i * 7 % 256 for i in range(20000))))
+        stream = io.BytesIO()
+        writer = compression.DecompressingWriter(OutputWriter(stream))
+        for chunk in iter_payloads(compression.compress_stream(io.BytesIO(data)), 1000):
+            writer.write(bytearray(chunk))
+        writer.close()
+        assert stream.getvalue() == data
+        assert writer.compressed < len(data)
+
+    def test_transfer(self):
+        data = base64.b64encode(bytes(bytearray(i % 251 for i in range(40000))))
+        output = io.BytesIO()
+        sender, receiver = loopback_transfer(lambda sender: sender.send(data), output, compress=True)
+        assert output.getvalue() == data
+        assert receiver.compressed
+        assert sender.next_index < len(data) // DataGram.PAYLOAD_SIZE
+
+
+class TestHandshake(unittest.TestCase):
+    def transfer(self, data, **sender_args):
+        output = io.BytesIO()
+        sender, receiver = loopback_transfer(lambda sender: sender.send(data), output, **sender_args)
+        assert output.getvalue() == data
+        return sender, receiver
+
+    def test_closes_with_fin(self):
+        sender, receiver = self.transfer(bytes(bytearray(i % 251 for i in range(20000))), starting_packet_num=1000)
+        assert receiver.closed and sender.done
+        assert receiver.isn == 1000
+        assert receiver.length == 20000
+
+    def test_empty(self):
+        sender, receiver = self.transfer(b"")
+        assert receiver.closed and receiver.length == 0
+
+    def test_window_from_syn(self):
+        sender, receiver = self.transfer(b"x" * 5000, window_size=16)
+        assert receiver.window_size == 16
+
+    def unanswered_sender(self, source):
+        sender = ReliableSender(timeout=0.01, simulator=LoopbackChannel(50006, 50005, network=LoopbackNetwork(),
+                                                                        drop_error_prob=0, random_error_prob=0,
+                                                                        swap_error_prob=0))
+        sender.start(source)
+        sender.fill()
+        return sender
+
+    def establish(self, sender):
+        sender.handle_acks([DataGram(b"", 0, flags=DataGram.FLAG_SYN | DataGram.FLAG_ACK).to_bytes()], time.time())
+        sender.fill()
+
+    def test_fin_without_answer(self):
+        sender = self.unanswered_sender(iter(()))
+        self.establish(sender)
+        assert sender.phase == ReliableSender.FIN_SENT
+        while not sender.done:
+            sender.expire(sender.control.deadline)
+        assert sender.phase == ReliableSender.CLOSED
+        assert sender.metrics["control_retransmits"] == ReliableSender.MAX_FIN_RETRIES
+
+    def test_syn_without_answer(self):
+        sender = self.unanswered_sender(iter(()))
+        while not sender.done:
+            sender.expire(sender.control.deadline)
+        assert sender.phase == ReliableSender.ABORTED
+        assert sender.metrics["control_retransmits"] == ReliableSender.MAX_RETRIES
+        assert sender.rtt.rto <= ReliableSender.MAX_RTO
+        self.assertRaises(socket.timeout, sender.run, lambda: sender.done)
+
+    def test_data_without_answer(self):
+        sender = self.unanswered_sender(iter([b"z" * (3 * DataGram.PAYLOAD_SIZE)]))
+        self.establish(sender)
+        assert sender.outstanding
+        while not sender.done:
+            sender.expire(min(entry.deadline for entry in sender.outstanding.values()))
+        assert sender.phase == ReliableSender.ABORTED
+        assert not sender.outstanding
+        assert len(sender.pool.free) == sender.window_size + 2
+        self.assertRaises(socket.timeout, sender.run, lambda: sender.done)
+
+    def test_send_file_error(self):
+        sender = self.unanswered_sender(iter(()))
+
+        def fail(finished):
+            next(sender.payloads)  # holds a slice of the memory map
+            raise socket.timeout("gone")
+
+        sender.run = fail
+        handle, path = tempfile.mkstemp()
+        os.write(handle, b"m" * (3 * DataGram.PAYLOAD_SIZE))
+        os.close(handle)
+        try:
+            # the error must come through, not one from closing a memory map that is still exported
+            self.assertRaises(socket.timeout, sender.send_file, path)
+        finally:
+            os.remove(path)
+
+    def test_concurrent_transfers(self):
+        results = dict()
+        threads = [threading.Thread(target=lambda isn: results.update({isn: self.transfer(b"y" * 30000,
+                                                                                       starting_packet_num=isn)}),
+                                    args=(isn,)) for isn in (5, 70000)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [5, 70000]
+        assert all(receiver.closed for sender, receiver in results.values())
+
+    def test_stream_length(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, "wb") as f:
+                f.write(b"abcdef")
+            with open(path, "rb") as f:
+                f.read(2)
+                assert stream_length(f) == 4
+        finally:
+            os.remove(path)
+        assert stream_length(iter([b"abc"])) is None
+        assert stream_length(io.BytesIO(b"abc")) is None
+
+
+class TestDelayedAck(unittest.TestCase):
+    def setUp(self):
+        self.receiver = ReliableReceiver(output=io.BytesIO(), simulator=LoopbackChannel(50005, 50006,
+                                                                                        network=LoopbackNetwork()))
+        syn = DataGram(header.SYN_PAYLOAD.pack(header.UNKNOWN_LENGTH, 64), 0, flags=DataGram.FLAG_SYN).to_bytes()
+        assert len(self.receiver.handle_frames([syn])) == 1
+
+    def frames(self, *packet_nums):
+        return self.receiver.handle_frames([DataGram(b"x", n).to_bytes() for n in packet_nums])
+
+    def test_every_few_frames(self):
+        for n in range(ReliableReceiver.ACK_EVERY - 1):
+            assert self.frames(n) == []
+        assert self.receiver.ack_deadline is not None
+        replies = self.frames(ReliableReceiver.ACK_EVERY - 1)
+        assert len(replies) == 1
+        assert Ack.from_bytes(replies[0]).cumulative == ReliableReceiver.ACK_EVERY
+        assert self.receiver.ack_deadline is None
+
+    def test_gap_acked_at_once(self):
+        replies = self.frames(1)
+        ack = Ack.from_bytes(replies[0])
+        assert ack.cumulative == 0 and ack.selective == [1]
+        assert len(self.frames(1)) == 1  # a duplicate means our ACK was lost
+
+    def test_delayed_copies(self):
+        assert self.frames(0) == []
+        replies = self.receiver.delayed_ack()
+        assert len(replies) == ReliableReceiver.DELAYED_ACK_COPIES
+        assert all(Ack.from_bytes(reply).cumulative == 1 for reply in replies)
+        assert self.receiver.delayed_ack() == []
+
+
+class TestNak(unittest.TestCase):
+    def test_round_trip(self):
+        nak = Nak.from_packets([2 ** 32 - 2, 2 ** 32 - 1, 0, 5, 7, 8])
+        assert nak.ranges == [(2 ** 32 - 2, 3), (5, 1), (7, 2)]
+        nak = Nak.from_datagram(DataGram.from_bytes(nak.to_bytes()))
+        assert nak.ranges == [(2 ** 32 - 2, 3), (5, 1), (7, 2)]
+        assert Nak.from_datagram(DataGram.from_bytes(Ack(3).to_bytes())) is None
+
+    def test_receiver_reports_gaps_and_corruption(self):
+        receiver = ReliableReceiver(output=io.BytesIO(), simulator=LoopbackChannel(50005, 50006,
+                                                                                   network=LoopbackNetwork()))
+        receiver.handle_frames([DataGram(header.SYN_PAYLOAD.pack(header.UNKNOWN_LENGTH, 64), 0,
+                                         flags=DataGram.FLAG_SYN).to_bytes()])
+        corrupted = DataGram(b"x", 4).to_bytes()
+        corrupted[-1] ^= 0xff
+        replies = receiver.handle_frames([DataGram(b"x", n).to_bytes() for n in (0, 3)] + [corrupted])
+        naks = [Nak.from_datagram(DataGram.from_bytes(reply)) for reply in replies]
+        # the corrupted frame is taken to be the one after the newest frame seen
+        assert [nak.ranges for nak in naks if nak is not None] == [[(1, 2), (4, 1)]]
+        assert receiver.handle_frames([DataGram(b"x", 3).to_bytes()])  # a duplicate raises no new NAK
+        assert all(Nak.from_datagram(DataGram.from_bytes(reply)) is None
+                   for reply in receiver.handle_frames([DataGram(b"x", 3).to_bytes()]))
+
+    def test_sender_resends_at_once(self):
+        sender = ReliableSender(window_size=8, controller=CongestionController(8), fec_enabled=False,
+                                simulator=LoopbackChannel(50006, 50005, network=LoopbackNetwork()))
+        sent = []
+        sender.transmit = lambda frames: sent.extend(DataGram.from_bytes(bytearray(f)) for f in frames)
+        sender.start(iter([b"x" * DataGram.PAYLOAD_SIZE] * 4))
+        sender.fill()
+        sender.handle_acks([DataGram(b"", 0, flags=DataGram.FLAG_SYN | DataGram.FLAG_ACK).to_bytes()], time.time())
+        sender.fill()
+        del sent[:]
+        now = time.time() + 1
+        sender.handle_acks([Nak([(1, 2)]).to_bytes()], now)
+        assert [datagram.packet_num for datagram in sent] == [1, 2]
+        assert sender.metrics["fast_retransmits"] == 2
+        sender.handle_acks([Nak([(1, 2)]).to_bytes()], now)
+        assert len(sent) == 2  # already resent within the last round trip
+
+
+class TestMessages(unittest.TestCase):
+    def test_round_trip(self):
+        sent = [b"", b"a", b"x" * 127, b"y" * 128, b"z" * 70000]
+        stream = b"".join(bytes(messages.encode_length(len(m))) + m for m in sent)
+        assert len(messages.encode_length(127)) == 1 and len(messages.encode_length(128)) == 2
+        chunks = [stream[i:i + 5] for i in range(0, len(stream), 5)]
+        assert list(messages.iter_messages(iter(chunks))) == sent
+        assert list(messages.iter_messages(io.BytesIO(stream))) == sent
+        with self.assertRaises(ValueError):
+            list(messages.iter_messages(iter([stream[:-1]])))
+
+    def test_coalescer(self):
+        coalescer = messages.Coalescer(16, flush_delay=60)
+        payloads = coalescer.payloads()
+        for _ in range(5):
+            coalescer.write(b"abc")
+        assert next(payloads) == b"\x03abc" * 4
+        assert next(payloads) == b""  # the rest waits for more messages
+        assert not coalescer.due(time.time()) and coalescer.due(time.time() + 60)
+        coalescer.close()
+        assert list(payloads) == [b"\x03abc"]
+
+    sent = [bytes(bytearray([i % 256])) * (i % 7) for i in range(2000)]
+
+    def send(self, sender):
+        sender.open()
+        for message in self.sent[:1000]:
+            sender.write(message)
+        sender.flush()  # leaves a short frame in the middle of the stream
+        assert sender.base == sender.next_index
+        for message in self.sent[1000:]:
+            sender.write(message)
+        sender.close()
+
+    def test_transfer(self):
+        output = io.BytesIO()
+        sender, receiver = loopback_transfer(self.send, output)
+        assert list(messages.iter_messages(io.BytesIO(output.getvalue()))) == self.sent
+        # 2000 messages of 3 bytes each on average, prefix included, fill only a few frames
+        assert sender.metrics["frames_sent"] <= 8000 // DataGram.PAYLOAD_SIZE + 2
+
+    def test_transfer_to_mapped_output(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            sender, receiver = loopback_transfer(self.send, output_path=path)
+            assert receiver.messages
+            with open(path, "rb") as f:
+                assert list(messages.iter_messages(f)) == self.sent
+        finally:
+            os.remove(path)
+
+    def test_flush_deadline(self):
+        def send(sender):
+            sender.open()
+            sender.write(b"hello")
+            time.sleep(messages.FLUSH_DELAY + 0.2)  # no further call: the driver sends the frame and takes its ACK
+            assert sender.metrics["frames_sent"] == 1 and sender.base == sender.next_index == 1
+            sender.close()
+
+        output = io.BytesIO()
+        loopback_transfer(send, output)
+        assert list(messages.iter_messages(io.BytesIO(output.getvalue()))) == [b"hello"]
+
+    def test_driver_error(self):
+        def send(sender):
+            sender.open()
+
+            def broken(now):
+                raise ValueError("broken")
+
+            sender.expire = broken  # the driver thread fails once a frame is in flight
+            sender.write(b"x")
+            self.assertRaises(ValueError, sender.flush)
+            self.assertRaises(ValueError, sender.write, b"y")
+            self.assertRaises(ValueError, sender.close)
+            assert sender.phase == ReliableSender.ABORTED
+
+        loopback_transfer(send, io.BytesIO(), timeout=0.5)
+
+    def test_keepalive(self):
+        interval = ReliableSender.KEEPALIVE_INTERVAL
+        ReliableSender.KEEPALIVE_INTERVAL = 0.05
+        try:
+            def send(sender):
+                sender.open()
+                time.sleep(0.6)  # twice the receiver's idle timeout, with nothing written
+                sender.write(b"late")
+                sender.close()
+
+            output = io.BytesIO()
+            sender, receiver = loopback_transfer(send, output, timeout=0.3)
+        finally:
+            ReliableSender.KEEPALIVE_INTERVAL = interval
+        assert sender.metrics["keepalives"] >= 5
+        assert receiver.closed and list(messages.iter_messages(io.BytesIO(output.getvalue()))) == [b"late"]
+
+
+class TestLoopback(unittest.TestCase):
+    @staticmethod
+    def run_frames(channel, count=2000, **probs):
+        return [channel.corrupt(bytearray([i % 256]) * 64, **probs) for i in range(count)]
+
+    def test_seed_repeats_errors(self):
+        probs = dict(drop_error_prob=0.05, random_error_prob=0.05, swap_error_prob=0.05)
+        first = self.run_frames(LoopbackChannel(1, 2, seed=7), **probs)
+        assert first == self.run_frames(LoopbackChannel(1, 2, seed=7), **probs)
+        assert first != self.run_frames(LoopbackChannel(1, 2, seed=8), **probs)
+
+    def test_replay_trace(self):
+        probs = dict(drop_error_prob=0.05, random_error_prob=0.05, swap_error_prob=0.05)
+        trace = ChannelTrace()
+        recorded = self.run_frames(LoopbackChannel(1, 2, seed=7, record=trace), **probs)
+        handle, path = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        try:
+            trace.save(path)
+            loaded = ChannelTrace.load(path)
+        finally:
+            os.remove(path)
+        replayed_trace = ChannelTrace()
+        replay = LoopbackChannel(1, 2, seed=8, replay=loaded, record=replayed_trace)
+        assert self.run_frames(replay, **probs) == recorded
+        assert replayed_trace.events == trace.events
+        assert replayed_trace.fillers == trace.fillers
+
+    def test_transfer(self):
+        data = bytes(bytearray(i % 251 for i in range(50000)))
+        output = io.BytesIO()
+        loopback_transfer(lambda sender: sender.send(data), output)
+        assert output.getvalue() == data
+
+
+class TestLogger(unittest.TestCase):
+    class Counted(object):
+        formatted = 0
+
+        def __str__(self):
+            TestLogger.Counted.formatted += 1
+            return "counted"
+
+    def test_lazy_file_and_formatting(self):
+        directory = tempfile.mkdtemp()
+        log_directory, utils.LOG_DIRECTORY = utils.LOG_DIRECTORY, directory
+        try:
+            logger = utils.Logger("TestLoggerLazy", logging.INFO)
+            logger.debug("skipped %s", TestLogger.Counted())
+            utils.flush()
+            assert os.listdir(directory) == []
+            assert TestLogger.Counted.formatted == 0
+            logger.info("written %s", TestLogger.Counted())
+            utils.flush()
+            names = os.listdir(directory)
+            assert len(names) == 1 and names[0].startswith("TestLoggerLazy_")
+            with open(os.path.join(directory, names[0])) as f:
+                assert f.read() == "INFO:TestLoggerLazy:written counted\n"
+            assert TestLogger.Counted.formatted == 1
+        finally:
+            utils.LOG_DIRECTORY = log_directory
+            for handler in logging.getLogger("TestLoggerLazy").handlers:
+                handler.target.close()
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counters(self):
+        metrics = Metrics()
+        metrics.count("frames")
+        metrics.count("frames", 4)
+        assert metrics["frames"] == 5
+        assert metrics["missing"] == 0
+        assert metrics.to_dict()["counters"] == {"frames": 5}
+
+    def test_histogram_buckets(self):
+        histogram = Histogram(unit=1e-3)
+        for value in (0.0005, 0.001, 0.003, 0.003):
+            histogram.add(value)
+        report = histogram.to_dict()
+        assert report["buckets"] == {"<1": 1, "<2": 1, "<4": 2}
+        assert report["count"] == 4
+        assert report["min"] == 0.0005 and report["max"] == 0.003
+
+    def test_channel_counts(self):
+        channel = ChannelSimulator(1, 2, seed=1)
+        for _ in range(10):
+            channel.corrupt(bytearray(64), drop_error_prob=1, random_error_prob=0, swap_error_prob=0)
+        assert channel.metrics["frames"] == 10
+        assert channel.metrics["drops"] == 10
+
+    def test_transfer_report(self):
+        data = bytes(bytearray(i % 251 for i in range(50000)))
+        sender, receiver = loopback_transfer(lambda sender: sender.send(data), io.BytesIO())
+        report = sender.metrics_report()
+        assert report["sender"]["frames_sent"] >= len(data) // DataGram.PAYLOAD_SIZE
+        assert report["channel"]["frames"] >= report["sender"]["frames_sent"]
+        assert sender.metrics.histograms["rtt"].count > 0
+        assert receiver.metrics["frames_received"] > 0
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_input(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            generate_input(path, 1000, seed=3)
+            with open(path, "rb") as f:
+                data = f.read()
+            assert len(data) == 1000
+            assert len(base64.b64decode(data[:996])) == 747
+            assert b"\n" not in data
+            assert file_digest(path)[1] == 1000
+        finally:
+            os.remove(path)
+
+
+class ExitingSender(object):
+    """
+    Sender whose stripe fails at once, as when its receiver stops answering
+    """
+
+    def __init__(self, inbound_port, outbound_port):
+        pass
+
+    def send_stream(self, source):
+        sys.exit(1)
+
+
+class IdleReceiver(object):
+    """
+    Receiver that gives up without any frame, leaving its transfer open
+    """
+    closed = False
+
+    def __init__(self, output, inbound_port, outbound_port):
+        pass
+
+    def receive(self):
+        pass
+
+
+class TestStriped(unittest.TestCase):
+    def test_interleave(self):
+        data = bytes(bytearray(i % 256 for i in range(23)))
+        for length in (0, 4, 8, 23):
+            segments = [data[i:i + 4] for i in range(0, length, 4)]
+            streams = [io.BytesIO(b"".join(segments[stripe::3])) for stripe in range(3)]
+            output = io.BytesIO()
+            assert interleave(streams, output, segment_size=4) == length
+            assert output.getvalue() == data[:length]
+
+    def test_ports(self):
+        assert stripe_ports(0) == (50005, 50006)
+        assert stripe_ports(2) == (50009, 50010)
+
+    def test_failed_sender(self):
+        # far more segments than the queues hold, so the parent would block on a dead stripe
+        source = io.BytesIO(b"s" * (20 * striped.SEGMENT_SIZE))
+        self.assertRaises(RuntimeError, striped.send, source, 2, ExitingSender)
+
+    def test_failed_receiver(self):
+        self.assertRaises(RuntimeError, striped.receive, io.BytesIO(), 2, IdleReceiver)
+
+
+@unittest.skipIf(aioengine is None, "asyncio needs Python 3")
+class TestAsyncEngine(unittest.TestCase):
+    def test_transfer(self):
+        data = bytes(bytearray(i % 251 for i in range(50000)))
+        output = io.BytesIO()
+        receiver = aioengine.AsyncReceiver(output=output)
+        thread = threading.Thread(target=receiver.receive)
+        thread.start()
+        try:
+            aioengine.AsyncSender().send(data)
+        finally:
+            receiver.stop()
+            thread.join()
+        assert output.getvalue() == data
+
+    def test_frames_queued_before_receive(self):
+        probs = dict(drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        output = io.BytesIO()
+        receiver = aioengine.AsyncReceiver(output=output, simulator=ChannelSimulator(50005, 50006, **probs))
+        sender = aioengine.AsyncSender(simulator=ChannelSimulator(50006, 50005, **probs))
+        thread = threading.Thread(target=sender.send, args=(b"queued",))
+        thread.start()
+        try:
+            time.sleep(0.2)  # the SYN waits on the receiver's socket until its loop takes the socket over
+            receiver.receive()
+        finally:
+            thread.join()
+        assert output.getvalue() == b"queued"
+        assert sender.metrics["control_retransmits"] == 0  # the queued SYN was answered, not lost
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,18 +1,152 @@
+"""
+Logging for the endpoints, and helpers shared between modules. Log records are queued for a background thread
+that writes them, so a log call never waits on the disk, and a message is only formatted once its level is known to
+be enabled.
+"""
+import atexit
 import datetime
 import logging
+import os
+import threading
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+# region Helper Functions
+
+LOG_DIRECTORY = os.curdir  # where Logger creates its files
+_writer = dict()  # "queue" and "thread" of this process's writer, and the "pid" it was started in
+_writer_lock = threading.Lock()  # endpoints in several threads of one process may log their first record at once
+
+
+def _enqueue(handler, record):
+    """
+    (INTERNAL) Queue a record for the writer thread, starting it if this process has none yet, e.g. after a fork
+    :param handler: handler that writes the record
+    :param record: logging.LogRecord
+    :return:
+    """
+    if _writer.get("pid") != os.getpid():
+        with _writer_lock:
+            if _writer.get("pid") != os.getpid():
+                _writer["queue"] = Queue.Queue()
+                _writer["thread"] = threading.Thread(target=_write, args=(_writer["queue"],))
+                _writer["thread"].daemon = True
+                _writer["thread"].start()
+                _writer["pid"] = os.getpid()
+    _writer["queue"].put((handler, record))
+
+
+def _write(queue):
+    """
+    (INTERNAL) Writer thread: hand every queued record to its handler
+    :param queue: queue of (handler, record)
+    :return:
+    """
+    while True:
+        item = queue.get()
+        try:
+            if item is None:
+                return
+            handler, record = item
+            handler.handle(record)
+        finally:
+            queue.task_done()
+
+
+def iter_chunks(source, size):
+    """
+    Read a stream as chunks, whether it is a file or already an iterator of chunks
+    :param source: file object with a read method, or an iterator of byte chunks of any size
+    :param size: bytes read from a file object per chunk
+    :return: iterator of byte chunks; an iterator source is returned as it is
+    """
+    if hasattr(source, 'read'):
+        return iter(lambda: source.read(size), b'')
+    return source
+
+
+def flush():
+    """
+    Wait until every record queued so far in this process is written. Everything is written at exit anyway, but
+    worker processes that leave through os._exit, as multiprocessing's do, must call it themselves.
+    :return:
+    """
+    if _writer.get("pid") == os.getpid():
+        _writer["queue"].join()
+
+
+def _stop():
+    """
+    (INTERNAL) Write what is left and end the writer thread, before Python 2 tears down the modules it still uses
+    :return:
+    """
+    if _writer.get("pid") == os.getpid():
+        _writer["queue"].put(None)
+        _writer["thread"].join()
+        del _writer["pid"]
+
+
+atexit.register(_stop)
+# endregion Helper Functions
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler that passes records to the writer thread, in the manner of Python 3's logging.handlers.QueueHandler
+    """
+
+    def __init__(self, target):
+        """
+        Create a QueueHandler
+        :param target: handler the writer thread writes the records with
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+
+    def emit(self, record):
+        # merge the arguments now, as they may change once the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        _enqueue(self.target, record)
 
 
 class Logger(object):
+    """
+    Log of one endpoint, written to a timestamped file named after it in LOG_DIRECTORY. The file is only created once
+    something is written to it. Pass format arguments rather than a formatted message: they are only merged when the
+    level is on.
+    """
 
     def __init__(self, name, debug_level):
-        now = datetime.datetime.now()
-        logging.basicConfig(filename='{}_{}.log'.format(name, datetime.datetime.strftime(now, "%Y_%m_%dT%H%M%S")),
-                            level=debug_level)
+        """
+        Create a Logger
+        :param name: log name, usually the class name
+        :param debug_level: lowest level written (e.g. logging.DEBUG)
+        """
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(debug_level)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            now = datetime.datetime.now()
+            file_name = '{}_{}.log'.format(name, datetime.datetime.strftime(now, "%Y_%m_%dT%H%M%S"))
+            target = logging.FileHandler(os.path.join(LOG_DIRECTORY, file_name), delay=True)
+            target.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            self.logger.addHandler(QueueHandler(target))
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def info(self, message, *args):
+        self.logger.info(message, *args)
 
-    @staticmethod
-    def info(message):
-        logging.info(message)
+    def debug(self, message, *args):
+        self.logger.debug(message, *args)
 
-    @staticmethod
-    def debug(message):
-        logging.debug(message)
+    def warning(self, message, *args):
+        self.logger.warning(message, *args)